@@ -7,7 +7,6 @@ import hashlib
 import json
 import base64
 import asyncio
-import sqlite3
 
 from functools import wraps
 from yookassa import Payment
@@ -54,7 +53,7 @@ from shop_bot.data_manager.database import (
     get_all_users,
     set_referral_balance,
     set_referral_balance_all,
-    DB_FILE,
+    get_transaction_status,
     get_user_paid_keys,
     get_user_trial_keys,
     set_pending_payment,
@@ -393,31 +392,7 @@ def has_ever_purchased_vpn_subscription(user_id: int) -> bool:
 
 
 def _stars_is_pending_transaction(payment_id: str) -> bool:
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT status FROM transactions WHERE payment_id = ?", (payment_id,)
-            )
-            row = cursor.fetchone()
-            return bool(row and row[0] == "pending")
-    except sqlite3.Error as e:
-        logger.error(f"Stars: Failed to check pending transaction {payment_id}: {e}")
-        return False
-
-
-def _get_transaction_status(payment_id: str) -> str | None:
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT status FROM transactions WHERE payment_id = ?", (payment_id,)
-            )
-            row = cursor.fetchone()
-            return row[0] if row else None
-    except sqlite3.Error as e:
-        logger.error(f"Failed to get transaction status for {payment_id}: {e}")
-        return None
+    return get_transaction_status(payment_id) == "pending"
 
 
 def _cryptobot_build_payload(payment_id: str) -> str:
@@ -3644,7 +3619,7 @@ async def process_successful_payment(bot: Bot, metadata: dict) -> bool:
         )
 
         existing_status = (
-            _get_transaction_status(payment_id_for_log) if provider_payment_id else None
+            get_transaction_status(payment_id_for_log) if provider_payment_id else None
         )
         if provider_payment_id and existing_status in {"pending", "processing", "paid"}:
             logger.info(
@@ -1,11 +1,19 @@
+import atexit
 import sqlite3
+import sys
+import threading
 from datetime import datetime
 from shop_bot.utils import time_utils
 import logging
 from pathlib import Path
 import json
 import os
-import uuid
+from typing import Iterator
+
+try:
+    import orjson
+except ImportError:  # optional speedup, see the "speedups" extra
+    orjson = None
 
 logger = logging.getLogger(__name__)
 
@@ -14,6 +22,300 @@ logger = logging.getLogger(__name__)
 DEFAULT_DB_PATH = Path(os.getcwd()) / "users.db"
 DB_FILE = Path(os.getenv("DB_PATH", DEFAULT_DB_PATH))
 
+# ─────────────────────────────────────────────
+# Connection management
+#
+# Connections are opened once and reused instead of reconnecting per query.
+# All writes go through a single process-wide connection serialized by
+# _write_lock; reads use one query-only connection per thread, which under WAL
+# never block (and are never blocked by) the writer. The write connection opens
+# its implicit transactions with BEGIN IMMEDIATE, so the database write lock is
+# taken up front (waiting up to busy_timeout) instead of being upgraded midway
+# and failing with SQLITE_BUSY when another process is writing.
+# ─────────────────────────────────────────────
+
+# Python's sqlite3 keeps an LRU of prepared statements per connection keyed by
+# SQL text; with long-lived connections a larger cache lets every hot helper
+# skip re-parsing. Hot queries below are module constants so each call site
+# hits the same cache entry.
+_STATEMENT_CACHE_SIZE = 512
+
+# UPDATE ... RETURNING needs SQLite 3.35+.
+_HAS_RETURNING = sqlite3.sqlite_version_info >= (3, 35, 0)
+
+_SQL_UPDATE_SETTING = "INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)"
+_SQL_GET_PLAN_BY_ID = "SELECT * FROM plans WHERE plan_id = ?"
+_SQL_GET_USER = "SELECT * FROM users WHERE telegram_id = ?"
+_SQL_GET_USER_BY_TOKEN = "SELECT * FROM users WHERE subscription_token = ?"
+_SQL_GET_KEY_BY_ID = "SELECT * FROM vpn_keys WHERE key_id = ?"
+_SQL_GET_KEY_BY_EMAIL = "SELECT * FROM vpn_keys WHERE key_email = ?"
+_SQL_GET_USER_KEYS = "SELECT * FROM vpn_keys WHERE user_id = ? ORDER BY key_id"
+_SQL_GET_USER_PAID_KEYS = (
+    "SELECT * FROM vpn_keys WHERE user_id = ? AND plan_id > 0 ORDER BY key_id"
+)
+_SQL_GET_USER_TRIAL_KEYS = (
+    "SELECT * FROM vpn_keys WHERE user_id = ? AND plan_id = 0 ORDER BY key_id"
+)
+_SQL_GET_SUPPORT_THREAD_ID = """
+    SELECT COALESCE(
+        (SELECT current_thread_id FROM support_tickets WHERE user_id = ?),
+        (SELECT thread_id FROM support_threads WHERE user_id = ?)
+    )
+"""
+_SQL_GET_USER_ID_BY_THREAD = """
+    SELECT COALESCE(
+        (SELECT user_id FROM support_tickets WHERE current_thread_id = ?),
+        (SELECT user_id FROM support_threads WHERE thread_id = ?)
+    )
+"""
+# NULL-safe IS comparisons let keyed and key-less (global) notifications share
+# one statement.
+_SQL_IS_NOTIFICATION_SENT = """
+    SELECT EXISTS (
+        SELECT 1 FROM sent_notifications
+        WHERE user_id = ? AND key_id IS ? AND notification_type = ? AND hours_mark IS ?
+    )
+"""
+_SQL_PAGINATED_TRANSACTIONS = """
+    SELECT p.*,
+           (
+               SELECT MAX(k.expiry_date) FROM vpn_keys k
+               WHERE k.user_id = p.user_id
+                 AND (p.meta_host_name IS NULL OR k.host_name = p.meta_host_name)
+           ) AS subscription_expires_at
+    FROM (
+        SELECT t.*,
+               json_valid(t.metadata) AS metadata_valid,
+               CASE WHEN json_valid(t.metadata)
+                    THEN json_extract(t.metadata, '$.host_name') END AS meta_host_name,
+               CASE WHEN json_valid(t.metadata)
+                    THEN json_extract(t.metadata, '$.plan_name') END AS meta_plan_name
+        FROM transactions t
+        ORDER BY t.created_date DESC
+        LIMIT ? OFFSET ?
+    ) p
+    ORDER BY p.created_date DESC
+"""
+_SQL_RECENT_TRANSACTIONS = """
+    SELECT transaction_id, payment_id, user_id, username, status, amount_rub,
+           payment_method, metadata, created_date
+    FROM transactions
+    ORDER BY created_date DESC
+    LIMIT ?
+"""
+_SQL_UPDATE_KEY_PLAN_ID = "UPDATE vpn_keys SET plan_id = ? WHERE key_id = ?"
+_SQL_DELETE_MISSING_KEY = "DELETE FROM vpn_keys_missing WHERE key_email = ?"
+_SQL_UPSERT_SUPPORT_THREAD = (
+    "INSERT OR REPLACE INTO support_threads (user_id, thread_id) VALUES (?, ?)"
+)
+_SQL_INSERT_SENT_NOTIFICATION = """
+    INSERT INTO sent_notifications (user_id, key_id, notification_type, hours_mark)
+    VALUES (?, ?, ?, ?)
+"""
+# Stored metadata that is missing or not valid JSON is normalised to "{}" so
+# the caller always gets a dict back.
+_SQL_RESERVE_PENDING_TRANSACTION = """
+    UPDATE transactions
+    SET status = 'processing',
+        amount_currency = COALESCE(?, amount_currency),
+        currency_name = COALESCE(?, currency_name),
+        payment_method = COALESCE(?, payment_method),
+        metadata = COALESCE(
+            ?, CASE WHEN json_valid(metadata) THEN metadata ELSE '{}' END
+        ),
+        created_date = COALESCE(created_date, ?),
+        username = COALESCE(
+            username,
+            (SELECT username FROM users WHERE telegram_id = transactions.user_id)
+        )
+    WHERE payment_id = ? AND status = 'pending'
+""" + ("RETURNING metadata" if _HAS_RETURNING else "")
+_SQL_GET_USERNAME = "SELECT username FROM users WHERE telegram_id = ?"
+_SQL_UPSERT_USER = """
+    INSERT INTO users (telegram_id, username, registration_date, referred_by, subscription_token)
+    VALUES (?, ?, ?, ?, lower(hex(randomblob(16))))
+    ON CONFLICT(telegram_id) DO UPDATE SET
+        username = excluded.username,
+        subscription_token = COALESCE(
+            NULLIF(users.subscription_token, ''),
+            excluded.subscription_token
+        )
+"""
+_SQL_INSERT_PENDING_TRANSACTION = """
+    INSERT INTO transactions
+    (username, payment_id, user_id, status, amount_rub, metadata, created_date)
+    VALUES (?, ?, ?, ?, ?, ?, ?)
+"""
+
+_CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA cache_size=-64000",
+    "PRAGMA temp_store=MEMORY",
+)
+
+# Checkpoint every 1000 WAL frames and truncate the WAL back to at most 64 MiB
+# afterwards, so a write burst cannot leave a huge -wal file behind.
+_WAL_PRAGMAS = (
+    "PRAGMA wal_autocheckpoint=1000",
+    "PRAGMA journal_size_limit=67108864",
+)
+
+_write_lock = threading.RLock()
+_rw_conn: sqlite3.Connection | None = None
+# Every open read connection, so reset_connections can close them all; each
+# thread reaches its own through _ro_local.
+_ro_conns: dict[int, sqlite3.Connection] = {}
+_ro_conns_lock = threading.Lock()
+_ro_local = threading.local()
+_ro_generation = 0
+
+
+class _ThreadReadConn:
+    """A thread's read connection, closed when the thread's locals are released."""
+
+    __slots__ = ("conn", "generation")
+
+    def __init__(self):
+        self.conn = _open_connection(read_only=True)
+        self.generation = _ro_generation
+        with _ro_conns_lock:
+            _ro_conns[id(self)] = self.conn
+
+    # The main thread's holder can be finalized after module globals are
+    # cleared at exit, so everything it needs is bound at definition time.
+    def __del__(
+        self,
+        _lock=_ro_conns_lock,
+        _conns=_ro_conns,
+        _is_finalizing=sys.is_finalizing,
+    ):
+        if _is_finalizing():
+            return
+        with _lock:
+            conn = _conns.pop(id(self), None)
+        if conn is not None:
+            conn.close()
+
+
+def _open_connection(read_only: bool = False) -> sqlite3.Connection:
+    conn = sqlite3.connect(
+        DB_FILE,
+        check_same_thread=False,
+        cached_statements=_STATEMENT_CACHE_SIZE,
+        isolation_level="DEFERRED" if read_only else "IMMEDIATE",
+    )
+    conn.row_factory = sqlite3.Row
+    conn.create_function("key_number", 2, _key_number, deterministic=True)
+    if not read_only:
+        conn.execute("PRAGMA journal_mode=WAL")
+        for pragma in _WAL_PRAGMAS:
+            conn.execute(pragma)
+    for pragma in _CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    if read_only:
+        conn.execute("PRAGMA query_only=ON")
+    return conn
+
+
+def _get_rw_conn() -> sqlite3.Connection:
+    """Return the shared write connection. Callers must hold _write_lock."""
+    global _rw_conn
+    if _rw_conn is None:
+        _rw_conn = _open_connection()
+    return _rw_conn
+
+
+def _get_ro_conn() -> sqlite3.Connection:
+    """Return the calling thread's cached query-only connection."""
+    holder = getattr(_ro_local, "holder", None)
+    if holder is None or holder.generation != _ro_generation:
+        holder = _ro_local.holder = _ThreadReadConn()
+    return holder.conn
+
+
+def reset_connections() -> None:
+    """
+    Close every cached connection; they are reopened lazily on next use.
+    Must be called before and after the database file is replaced on disk.
+    """
+    global _rw_conn, _ro_generation, _sn_date_column
+    with _write_lock:
+        _sn_date_column = None
+        if _rw_conn is not None:
+            try:
+                _rw_conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.Error as e:
+                logging.warning(f"WAL checkpoint before reconnect failed: {e}")
+            _rw_conn.close()
+            _rw_conn = None
+        with _ro_conns_lock:
+            for conn in _ro_conns.values():
+                conn.close()
+            _ro_conns.clear()
+            # Threads still holding a closed connection open a new one on next use
+            _ro_generation += 1
+    invalidate_settings_cache()
+
+
+def checkpoint_wal() -> None:
+    """Fold the WAL back into the main database file and truncate it."""
+    with _write_lock:
+        try:
+            _get_rw_conn().execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        except sqlite3.Error as e:
+            logging.warning(f"WAL checkpoint failed: {e}")
+
+
+def optimize_database() -> None:
+    """Refresh query-planner statistics where SQLite considers them stale."""
+    with _write_lock:
+        if _rw_conn is None:
+            return
+        try:
+            _rw_conn.execute("PRAGMA analysis_limit=400")
+            _rw_conn.execute("PRAGMA optimize")
+        except sqlite3.Error as e:
+            logging.warning(f"PRAGMA optimize failed: {e}")
+
+
+atexit.register(optimize_database)
+
+
+def _fetch_dicts(cursor: sqlite3.Cursor) -> list[dict]:
+    """Build result dicts straight from raw tuples, skipping per-row sqlite3.Row objects."""
+    cursor.row_factory = None
+    columns = [column[0] for column in cursor.description]
+    return [dict(zip(columns, row)) for row in cursor]
+
+
+def _first_column(_cursor: sqlite3.Cursor, row: tuple):
+    """Scalar row_factory: fetchone() yields the value itself, fetchall() a flat list."""
+    return row[0]
+
+
+def _fetch_dict(cursor: sqlite3.Cursor) -> dict | None:
+    """Single-row counterpart of _fetch_dicts."""
+    cursor.row_factory = None
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    return dict(zip([column[0] for column in cursor.description], row))
+
+
+def _dump_metadata(metadata) -> str:
+    """Serialize transaction metadata, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.dumps(metadata, option=orjson.OPT_NON_STR_KEYS).decode()
+    return json.dumps(metadata)
+
+
+def _load_metadata(raw: str | bytes):
+    """Parse transaction metadata, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(raw)
+    return json.loads(raw)
+
 
 def _now_iso() -> str:
     return time_utils.get_msk_now().isoformat()
@@ -81,167 +383,180 @@ DEFAULT_BOT_SETTINGS = {
 }
 
 
+# Base schema for a fresh database. Columns added later live in run_migration.
+_TRANSACTIONS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS transactions (
+        username TEXT,
+        transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        payment_id TEXT UNIQUE NOT NULL,
+        user_id INTEGER NOT NULL,
+        status TEXT NOT NULL,
+        amount_rub REAL NOT NULL,
+        amount_currency REAL,
+        currency_name TEXT,
+        payment_method TEXT,
+        metadata TEXT,
+        created_date TIMESTAMP
+    )
+"""
+
+_SUPPORT_TICKETS_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS support_tickets (
+        ticket_id INTEGER PRIMARY KEY AUTOINCREMENT,
+        user_id INTEGER NOT NULL UNIQUE,
+        username TEXT,
+        status TEXT NOT NULL DEFAULT 'open',
+        current_thread_id INTEGER,
+        created_at TEXT NOT NULL,
+        updated_at TEXT NOT NULL,
+        closed_at TEXT,
+        reopen_count INTEGER NOT NULL DEFAULT 0,
+        last_message_at TEXT,
+        last_user_message_at TEXT,
+        last_admin_message_at TEXT,
+        last_delivery_error TEXT
+    )
+"""
+
+_SUPPORT_MESSAGES_TABLE_SQL = """
+    CREATE TABLE IF NOT EXISTS support_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ticket_id INTEGER NOT NULL,
+        user_id INTEGER NOT NULL,
+        direction TEXT NOT NULL,
+        sender_telegram_id INTEGER,
+        sender_name TEXT,
+        message_type TEXT NOT NULL DEFAULT 'text',
+        text TEXT,
+        created_at TEXT NOT NULL,
+        source_chat_id INTEGER,
+        source_message_id INTEGER,
+        source_thread_id INTEGER,
+        delivery_status TEXT NOT NULL DEFAULT 'pending',
+        delivery_error TEXT
+    )
+"""
+
+_SCHEMA_SQL = ";\n".join(
+    (
+        """
+            CREATE TABLE IF NOT EXISTS users (
+                telegram_id INTEGER PRIMARY KEY, username TEXT, total_spent REAL DEFAULT 0,
+                total_months INTEGER DEFAULT 0, trial_used BOOLEAN DEFAULT 0,
+                agreed_to_terms BOOLEAN DEFAULT 0,
+                registration_date TIMESTAMP,
+                is_banned BOOLEAN DEFAULT 0,
+                referred_by INTEGER,
+                referral_balance REAL DEFAULT 0,
+                referral_balance_all REAL DEFAULT 0,
+                subscription_token TEXT UNIQUE
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS vpn_keys_missing (
+                key_email TEXT PRIMARY KEY,
+                host_name TEXT,
+                first_seen TIMESTAMP
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS vpn_keys (
+                key_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                host_name TEXT NOT NULL,
+                xui_client_uuid TEXT NOT NULL,
+                key_email TEXT NOT NULL UNIQUE,
+                expiry_date TIMESTAMP,
+                created_date TIMESTAMP,
+                connection_string TEXT
+            )
+        """,
+        _TRANSACTIONS_TABLE_SQL,
+        """
+            CREATE TABLE IF NOT EXISTS bot_settings (
+                key TEXT PRIMARY KEY,
+                value TEXT
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS support_threads (
+                user_id INTEGER PRIMARY KEY,
+                thread_id INTEGER NOT NULL
+            )
+        """,
+        _SUPPORT_TICKETS_TABLE_SQL,
+        _SUPPORT_MESSAGES_TABLE_SQL,
+        """
+            CREATE TABLE IF NOT EXISTS xui_hosts(
+                host_name TEXT NOT NULL,
+                host_url TEXT NOT NULL,
+                host_username TEXT NOT NULL,
+                host_pass TEXT NOT NULL,
+                host_inbound_id INTEGER NOT NULL
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS mtg_hosts (
+                host_name TEXT NOT NULL PRIMARY KEY,
+                host_url TEXT NOT NULL,
+                username TEXT NOT NULL,
+                password TEXT NOT NULL,
+                is_enabled INTEGER NOT NULL DEFAULT 1
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS plans (
+                plan_id INTEGER PRIMARY KEY AUTOINCREMENT,
+                host_name TEXT NOT NULL,
+                plan_name TEXT NOT NULL,
+                months INTEGER NOT NULL,
+                price REAL NOT NULL
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS payment_method_rules (
+                context_key TEXT NOT NULL,
+                method TEXT NOT NULL,
+                is_enabled INTEGER NOT NULL DEFAULT 1,
+                PRIMARY KEY (context_key, method)
+            )
+        """,
+        """
+            CREATE TABLE IF NOT EXISTS p2p_requests (
+                request_id TEXT PRIMARY KEY,
+                user_id INTEGER NOT NULL,
+                plan_id INTEGER,
+                months INTEGER,
+                price REAL,
+                action TEXT,
+                key_id INTEGER,
+                host_name TEXT,
+                customer_email TEXT,
+                submitted INTEGER NOT NULL DEFAULT 0,
+                created_at TEXT NOT NULL
+            )
+        """,
+    )
+)
+
+
 def initialize_db():
     try:
         # Ensure directory exists
         DB_FILE.parent.mkdir(parents=True, exist_ok=True)
 
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("PRAGMA journal_mode=WAL;")
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS users (
-                    telegram_id INTEGER PRIMARY KEY, username TEXT, total_spent REAL DEFAULT 0,
-                    total_months INTEGER DEFAULT 0, trial_used BOOLEAN DEFAULT 0,
-                    agreed_to_terms BOOLEAN DEFAULT 0,
-                    registration_date TIMESTAMP,
-                    is_banned BOOLEAN DEFAULT 0,
-                    referred_by INTEGER,
-                    referral_balance REAL DEFAULT 0,
-                    referral_balance_all REAL DEFAULT 0,
-                    subscription_token TEXT UNIQUE
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS vpn_keys_missing (
-                    key_email TEXT PRIMARY KEY,
-                    host_name TEXT,
-                    first_seen TIMESTAMP
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS vpn_keys (
-                    key_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL,
-                    host_name TEXT NOT NULL,
-                    xui_client_uuid TEXT NOT NULL,
-                    key_email TEXT NOT NULL UNIQUE,
-                    expiry_date TIMESTAMP,
-                    created_date TIMESTAMP,
-                    connection_string TEXT
-                )
-            """)
-
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS transactions (
-                    username TEXT,
-                    transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    payment_id TEXT UNIQUE NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    status TEXT NOT NULL,
-                    amount_rub REAL NOT NULL,
-                    amount_currency REAL,
-                    currency_name TEXT,
-                    payment_method TEXT,
-                    metadata TEXT,
-                    created_date TIMESTAMP
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS bot_settings (
-                    key TEXT PRIMARY KEY,
-                    value TEXT
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS support_threads (
-                    user_id INTEGER PRIMARY KEY,
-                    thread_id INTEGER NOT NULL
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS support_tickets (
-                    ticket_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL UNIQUE,
-                    username TEXT,
-                    status TEXT NOT NULL DEFAULT 'open',
-                    current_thread_id INTEGER,
-                    created_at TEXT NOT NULL,
-                    updated_at TEXT NOT NULL,
-                    closed_at TEXT,
-                    reopen_count INTEGER NOT NULL DEFAULT 0,
-                    last_message_at TEXT,
-                    last_user_message_at TEXT,
-                    last_admin_message_at TEXT,
-                    last_delivery_error TEXT
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS support_messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    ticket_id INTEGER NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    direction TEXT NOT NULL,
-                    sender_telegram_id INTEGER,
-                    sender_name TEXT,
-                    message_type TEXT NOT NULL DEFAULT 'text',
-                    text TEXT,
-                    created_at TEXT NOT NULL,
-                    source_chat_id INTEGER,
-                    source_message_id INTEGER,
-                    source_thread_id INTEGER,
-                    delivery_status TEXT NOT NULL DEFAULT 'pending',
-                    delivery_error TEXT
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS xui_hosts(
-                    host_name TEXT NOT NULL,
-                    host_url TEXT NOT NULL,
-                    host_username TEXT NOT NULL,
-                    host_pass TEXT NOT NULL,
-                    host_inbound_id INTEGER NOT NULL
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS mtg_hosts (
-                    host_name TEXT NOT NULL PRIMARY KEY,
-                    host_url TEXT NOT NULL,
-                    username TEXT NOT NULL,
-                    password TEXT NOT NULL,
-                    is_enabled INTEGER NOT NULL DEFAULT 1
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS plans (
-                    plan_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    host_name TEXT NOT NULL,
-                    plan_name TEXT NOT NULL,
-                    months INTEGER NOT NULL,
-                    price REAL NOT NULL
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS payment_method_rules (
-                    context_key TEXT NOT NULL,
-                    method TEXT NOT NULL,
-                    is_enabled INTEGER NOT NULL DEFAULT 1,
-                    PRIMARY KEY (context_key, method)
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS p2p_requests (
-                    request_id TEXT PRIMARY KEY,
-                    user_id INTEGER NOT NULL,
-                    plan_id INTEGER,
-                    months INTEGER,
-                    price REAL,
-                    action TEXT,
-                    key_id INTEGER,
-                    host_name TEXT,
-                    customer_email TEXT,
-                    submitted INTEGER NOT NULL DEFAULT 0,
-                    created_at TEXT NOT NULL
-                )
-            """)
+            cursor.executescript(_SCHEMA_SQL)
             run_migration()
-            for key, value in DEFAULT_BOT_SETTINGS.items():
-                cursor.execute(
-                    "INSERT OR IGNORE INTO bot_settings (key, value) VALUES (?, ?)",
-                    (key, value),
-                )
+            cursor.executemany(
+                "INSERT OR IGNORE INTO bot_settings (key, value) VALUES (?, ?)",
+                list(DEFAULT_BOT_SETTINGS.items()),
+            )
             conn.commit()
+            invalidate_settings_cache()
             logging.info(f"Database initialized successfully at {DB_FILE}")
+        optimize_database()
 
         # Clear any stale pending payment flags on startup
         clear_all_pending_payments()
@@ -249,6 +564,17 @@ def initialize_db():
         logging.error(f"Database error on initialization: {e}")
 
 
+# Stored in PRAGMA user_version once run_migration has completed. Bump it
+# whenever run_migration or _PERFORMANCE_INDEXES gains a new step, otherwise
+# already migrated databases will skip that step.
+CURRENT_SCHEMA_VERSION = 4
+
+
+def _table_columns(cursor: sqlite3.Cursor, table: str) -> set[str]:
+    cursor.execute(f"PRAGMA table_info({table})")
+    return {row[1] for row in cursor.fetchall()}
+
+
 def run_migration():
     if not DB_FILE.exists():
         logging.error(
@@ -259,13 +585,24 @@ def run_migration():
     logging.info(f"Starting the migration of the database: {DB_FILE}")
 
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
 
+            cursor.execute("PRAGMA user_version")
+            schema_version = cursor.fetchone()[0]
+            if schema_version >= CURRENT_SCHEMA_VERSION:
+                logging.info(
+                    f"Database schema is up to date (version {schema_version}), migration skipped."
+                )
+                return
+
+            # Steps below that only log a warning on failure clear this, so the
+            # version is not stamped and they are retried on the next start.
+            all_steps_ok = True
+
             logging.info("The migration of the table 'users' ...")
 
-            cursor.execute("PRAGMA table_info(users)")
-            columns = [row[1] for row in cursor.fetchall()]
+            columns = _table_columns(cursor, "users")
 
             if "referred_by" not in columns:
                 cursor.execute("ALTER TABLE users ADD COLUMN referred_by INTEGER")
@@ -299,22 +636,17 @@ def run_migration():
 
                 # Generate tokens for existing users
                 cursor.execute(
-                    "SELECT telegram_id FROM users WHERE subscription_token IS NULL"
+                    "UPDATE users SET subscription_token = lower(hex(randomblob(16))) "
+                    "WHERE subscription_token IS NULL"
                 )
-                users_without_token = cursor.fetchall()
-                for (uid,) in users_without_token:
-                    new_token = str(uuid.uuid4())
-                    cursor.execute(
-                        "UPDATE users SET subscription_token = ? WHERE telegram_id = ?",
-                        (new_token, uid),
-                    )
+                backfilled = cursor.rowcount
 
                 # Create unique index after populating
                 cursor.execute(
                     "CREATE UNIQUE INDEX IF NOT EXISTS idx_users_subscription_token ON users (subscription_token)"
                 )
                 logging.info(
-                    f" -> Generated subscription tokens for {len(users_without_token)} existing users and created unique index."
+                    f" -> Generated subscription tokens for {backfilled} existing users and created unique index."
                 )
             else:
                 logging.info(" -> The column 'subscription_token' already exists.")
@@ -324,23 +656,16 @@ def run_migration():
                 )
                 # Backfill missing tokens if any users have NULL/empty values
                 cursor.execute(
-                    "SELECT telegram_id FROM users WHERE subscription_token IS NULL OR subscription_token = ''"
+                    "UPDATE users SET subscription_token = lower(hex(randomblob(16))) "
+                    "WHERE subscription_token IS NULL OR subscription_token = ''"
                 )
-                users_without_token = cursor.fetchall()
-                for (uid,) in users_without_token:
-                    new_token = str(uuid.uuid4())
-                    cursor.execute(
-                        "UPDATE users SET subscription_token = ? WHERE telegram_id = ?",
-                        (new_token, uid),
-                    )
-                if users_without_token:
+                if cursor.rowcount > 0:
                     logging.info(
-                        f" -> Backfilled subscription tokens for {len(users_without_token)} users."
+                        f" -> Backfilled subscription tokens for {cursor.rowcount} users."
                     )
 
             # Check for is_enabled column in xui_hosts
-            cursor.execute("PRAGMA table_info(xui_hosts)")
-            host_columns = [row[1] for row in cursor.fetchall()]
+            host_columns = _table_columns(cursor, "xui_hosts")
             if "is_enabled" not in host_columns:
                 cursor.execute(
                     "ALTER TABLE xui_hosts ADD COLUMN is_enabled BOOLEAN DEFAULT 1"
@@ -351,10 +676,10 @@ def run_migration():
             else:
                 logging.info(" -> The column 'is_enabled' already exists in xui_hosts.")
 
-            cursor.execute("PRAGMA table_info(vpn_keys)")
-            vpn_keys_columns = [row[1] for row in cursor.fetchall()]
+            vpn_keys_columns = _table_columns(cursor, "vpn_keys")
             if "connection_string" not in vpn_keys_columns:
                 cursor.execute("ALTER TABLE vpn_keys ADD COLUMN connection_string TEXT")
+                vpn_keys_columns.add("connection_string")
                 logging.info(
                     " -> The column 'connection_string' is successfully added to vpn_keys."
                 )
@@ -370,27 +695,35 @@ def run_migration():
                 "cryptobot_enabled": "false",
             }
 
-            for key, default_value in new_payment_settings.items():
-                cursor.execute("SELECT 1 FROM bot_settings WHERE key = ?", (key,))
-                if not cursor.fetchone():
-                    cursor.execute(
-                        "INSERT INTO bot_settings (key, value) VALUES (?, ?)",
-                        (key, default_value),
-                    )
-                    logging.info(
-                        f" -> Added setting '{key}' with default value '{default_value}'."
-                    )
-                else:
-                    logging.info(f" -> Setting '{key}' already exists.")
+            placeholders = ",".join("?" * len(new_payment_settings))
+            cursor.execute(
+                f"SELECT key FROM bot_settings WHERE key IN ({placeholders})",
+                tuple(new_payment_settings),
+            )
+            existing_settings = {row[0] for row in cursor.fetchall()}
+            missing_settings = [
+                (key, default_value)
+                for key, default_value in new_payment_settings.items()
+                if key not in existing_settings
+            ]
+            cursor.executemany(
+                "INSERT INTO bot_settings (key, value) VALUES (?, ?)",
+                missing_settings,
+            )
+            for key, default_value in missing_settings:
+                logging.info(
+                    f" -> Added setting '{key}' with default value '{default_value}'."
+                )
+            for key in existing_settings:
+                logging.info(f" -> Setting '{key}' already exists.")
 
             # Add plan_id column to vpn_keys for trial/paid key distinction
             logging.info("Migration of vpn_keys table to add plan_id...")
-            cursor.execute("PRAGMA table_info(vpn_keys)")
-            vpn_keys_columns = [row[1] for row in cursor.fetchall()]
             if "plan_id" not in vpn_keys_columns:
                 cursor.execute(
                     "ALTER TABLE vpn_keys ADD COLUMN plan_id INTEGER DEFAULT 0"
                 )
+                vpn_keys_columns.add("plan_id")
                 logging.info(
                     " -> The column 'plan_id' is successfully added to vpn_keys."
                 )
@@ -402,12 +735,11 @@ def run_migration():
 
             # Add service_type column to vpn_keys (distinguishes 'xui' from 'mtg' keys)
             logging.info("Migration of vpn_keys table to add service_type...")
-            cursor.execute("PRAGMA table_info(vpn_keys)")
-            vpn_keys_cols = [row[1] for row in cursor.fetchall()]
-            if "service_type" not in vpn_keys_cols:
+            if "service_type" not in vpn_keys_columns:
                 cursor.execute(
                     "ALTER TABLE vpn_keys ADD COLUMN service_type TEXT NOT NULL DEFAULT 'xui'"
                 )
+                vpn_keys_columns.add("service_type")
                 logging.info(
                     " -> The column 'service_type' is successfully added to vpn_keys."
                 )
@@ -418,8 +750,7 @@ def run_migration():
 
             # Add service_type column to plans
             logging.info("Migration of plans table to add service_type...")
-            cursor.execute("PRAGMA table_info(plans)")
-            plans_cols = [row[1] for row in cursor.fetchall()]
+            plans_cols = _table_columns(cursor, "plans")
             if "service_type" not in plans_cols:
                 cursor.execute(
                     "ALTER TABLE plans ADD COLUMN service_type TEXT NOT NULL DEFAULT 'xui'"
@@ -434,9 +765,7 @@ def run_migration():
             logging.info(
                 "Migration of users table to add pending_payment protection..."
             )
-            cursor.execute("PRAGMA table_info(users)")
-            user_columns = [row[1] for row in cursor.fetchall()]
-            if "pending_payment" not in user_columns:
+            if "pending_payment" not in columns:
                 cursor.execute(
                     "ALTER TABLE users ADD COLUMN pending_payment BOOLEAN DEFAULT 0"
                 )
@@ -448,40 +777,6 @@ def run_migration():
                     " -> The column 'pending_payment' already exists in users."
                 )
 
-            # Create indexes for performance
-            logging.info("Creating performance indexes...")
-            try:
-                cursor.execute(
-                    "CREATE INDEX IF NOT EXISTS idx_vpn_keys_user_id ON vpn_keys(user_id)"
-                )
-                logging.info(" -> Index on vpn_keys.user_id created.")
-            except sqlite3.OperationalError:
-                logging.info(" -> Index on vpn_keys.user_id already exists.")
-
-            try:
-                cursor.execute(
-                    "CREATE INDEX IF NOT EXISTS idx_vpn_keys_expiry ON vpn_keys(expiry_date)"
-                )
-                logging.info(" -> Index on vpn_keys.expiry_date created.")
-            except sqlite3.OperationalError:
-                logging.info(" -> Index on vpn_keys.expiry_date already exists.")
-
-            try:
-                cursor.execute(
-                    "CREATE INDEX IF NOT EXISTS idx_transactions_user_id ON transactions(user_id)"
-                )
-                logging.info(" -> Index on transactions.user_id created.")
-            except sqlite3.OperationalError:
-                logging.info(" -> Index on transactions.user_id already exists.")
-
-            try:
-                cursor.execute(
-                    "CREATE INDEX IF NOT EXISTS idx_users_banned ON users(is_banned)"
-                )
-                logging.info(" -> Index on users.is_banned created.")
-            except sqlite3.OperationalError:
-                logging.info(" -> Index on users.is_banned already exists.")
-
             # Hard guard: one paid key per user per host.
             # Prevents accidental duplicates that inflate "servers count" and break global expiry logic.
             try:
@@ -494,6 +789,7 @@ def run_migration():
                 )
             except sqlite3.OperationalError as e:
                 logging.warning(f" -> Could not create paid-keys unique index: {e}")
+                all_steps_ok = False
 
             logging.info("The table 'users' has been successfully updated.")
 
@@ -505,8 +801,7 @@ def run_migration():
             table_exists = cursor.fetchone()
 
             if table_exists:
-                cursor.execute("PRAGMA table_info(transactions)")
-                trans_columns = [row[1] for row in cursor.fetchall()]
+                trans_columns = _table_columns(cursor, "transactions")
 
                 if (
                     "payment_id" in trans_columns
@@ -550,56 +845,33 @@ def run_migration():
                     sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
                 )
             """)
+            # Historical schema used "sent_at". Some old DBs may have "created_at".
+            sn_columns = _table_columns(cursor, "sent_notifications")
+            if "sent_at" not in sn_columns and "created_at" not in sn_columns:
+                # ALTER TABLE only accepts a constant default on a populated
+                # table, so add the column bare, backfill existing rows and let
+                # a trigger stamp new ones in place of the column default.
+                cursor.execute(
+                    "ALTER TABLE sent_notifications ADD COLUMN sent_at TIMESTAMP"
+                )
+                cursor.execute(
+                    "UPDATE sent_notifications SET sent_at = CURRENT_TIMESTAMP WHERE sent_at IS NULL"
+                )
+                cursor.execute("""
+                    CREATE TRIGGER IF NOT EXISTS trg_sent_notifications_sent_at
+                    AFTER INSERT ON sent_notifications
+                    WHEN NEW.sent_at IS NULL
+                    BEGIN
+                        UPDATE sent_notifications SET sent_at = CURRENT_TIMESTAMP
+                        WHERE id = NEW.id;
+                    END
+                """)
+                logging.info(" -> The column 'sent_at' is successfully added.")
             logging.info(" -> Table 'sent_notifications' is ready.")
 
             logging.info("The migration of support ticket tables ...")
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS support_tickets (
-                    ticket_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    user_id INTEGER NOT NULL UNIQUE,
-                    username TEXT,
-                    status TEXT NOT NULL DEFAULT 'open',
-                    current_thread_id INTEGER,
-                    created_at TEXT NOT NULL,
-                    updated_at TEXT NOT NULL,
-                    closed_at TEXT,
-                    reopen_count INTEGER NOT NULL DEFAULT 0,
-                    last_message_at TEXT,
-                    last_user_message_at TEXT,
-                    last_admin_message_at TEXT,
-                    last_delivery_error TEXT
-                )
-            """)
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS support_messages (
-                    id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    ticket_id INTEGER NOT NULL,
-                    user_id INTEGER NOT NULL,
-                    direction TEXT NOT NULL,
-                    sender_telegram_id INTEGER,
-                    sender_name TEXT,
-                    message_type TEXT NOT NULL DEFAULT 'text',
-                    text TEXT,
-                    created_at TEXT NOT NULL,
-                    source_chat_id INTEGER,
-                    source_message_id INTEGER,
-                    source_thread_id INTEGER,
-                    delivery_status TEXT NOT NULL DEFAULT 'pending',
-                    delivery_error TEXT
-                )
-            """)
-            cursor.execute(
-                "CREATE INDEX IF NOT EXISTS idx_support_tickets_status_updated ON support_tickets(status, updated_at DESC)"
-            )
-            cursor.execute(
-                "CREATE INDEX IF NOT EXISTS idx_support_tickets_thread ON support_tickets(current_thread_id)"
-            )
-            cursor.execute(
-                "CREATE INDEX IF NOT EXISTS idx_support_messages_ticket_created ON support_messages(ticket_id, created_at ASC)"
-            )
-            cursor.execute(
-                "CREATE INDEX IF NOT EXISTS idx_support_messages_user_created ON support_messages(user_id, created_at ASC)"
-            )
+            cursor.execute(_SUPPORT_TICKETS_TABLE_SQL)
+            cursor.execute(_SUPPORT_MESSAGES_TABLE_SQL)
 
             backfill_now = _now_iso()
             cursor.execute("SELECT user_id, thread_id FROM support_threads")
@@ -644,7 +916,18 @@ def run_migration():
             )
             logging.info(" -> UNIQUE index on xui_hosts.host_name is ready.")
 
+            if not _create_indexes(cursor):
+                all_steps_ok = False
+
+            if all_steps_ok:
+                cursor.execute(f"PRAGMA user_version = {CURRENT_SCHEMA_VERSION}")
+            else:
+                logging.warning(
+                    "Migration finished with warnings; schema version not updated, "
+                    "the migration will run again on next start."
+                )
             conn.commit()
+            invalidate_settings_cache()
 
         logging.info("--- The database is successfully completed! ---")
 
@@ -652,27 +935,72 @@ def run_migration():
         logging.error(f"An error occurred during migration: {e}")
 
 
+# Secondary indexes for hot query predicates. They are created once at the end
+# of run_migration, after every table rebuild and backfill, so bulk writes
+# during migration don't pay for index maintenance and a recreated table
+# (e.g. transactions) gets its indexes back.
+_PERFORMANCE_INDEXES = (
+    # Serves per-user listings incl. the paid/trial split ordered by key_id.
+    ("idx_vpn_keys_user_plan", "vpn_keys(user_id, plan_id, key_id)"),
+    # plan_id > 0 is a range on the composite above and would need a sort by
+    # key_id; this partial index holds only paid keys, already in key_id order.
+    ("idx_vpn_keys_user_paid", "vpn_keys(user_id, key_id) WHERE plan_id > 0"),
+    # Serves MAX(expiry_date) per user/host without touching the table.
+    ("idx_vpn_keys_user_host_expiry", "vpn_keys(user_id, host_name, expiry_date)"),
+    ("idx_vpn_keys_expiry", "vpn_keys(expiry_date)"),
+    ("idx_vpn_keys_host_name", "vpn_keys(host_name)"),
+    ("idx_plans_host_name", "plans(host_name)"),
+    ("idx_users_banned", "users(is_banned)"),
+    ("idx_users_referred_by", "users(referred_by)"),
+    ("idx_transactions_user_id", "transactions(user_id)"),
+    ("idx_transactions_created", "transactions(created_date DESC)"),
+    ("idx_support_threads_thread", "support_threads(thread_id)"),
+    # Covers both the single-probe and the bulk json_each probe of the notifier.
+    (
+        "idx_sent_notifications_lookup",
+        "sent_notifications(user_id, notification_type, hours_mark, key_id)",
+    ),
+    ("idx_support_tickets_status_updated", "support_tickets(status, updated_at DESC)"),
+    ("idx_support_tickets_thread", "support_tickets(current_thread_id)"),
+    (
+        "idx_support_messages_ticket_created",
+        "support_messages(ticket_id, created_at ASC)",
+    ),
+    (
+        "idx_support_messages_user_created",
+        "support_messages(user_id, created_at ASC)",
+    ),
+)
+
+
+# Superseded by a composite index with the same leading column.
+_OBSOLETE_INDEXES = ("idx_vpn_keys_user_id",)
+
+
+def _create_indexes(cursor: sqlite3.Cursor) -> bool:
+    """Create the performance indexes; returns False if any of them failed."""
+    logging.info("Creating performance indexes...")
+    for index_name in _OBSOLETE_INDEXES:
+        cursor.execute(f"DROP INDEX IF EXISTS {index_name}")
+    all_created = True
+    for index_name, target in _PERFORMANCE_INDEXES:
+        try:
+            cursor.execute(f"CREATE INDEX IF NOT EXISTS {index_name} ON {target}")
+        except sqlite3.OperationalError as e:
+            logging.warning(f" -> Could not create index {index_name}: {e}")
+            all_created = False
+    if all_created:
+        logging.info(" -> Performance indexes are ready.")
+    return all_created
+
+
 def create_new_transactions_table(cursor: sqlite3.Cursor):
-    cursor.execute("""
-        CREATE TABLE IF NOT EXISTS transactions (
-            username TEXT,
-            transaction_id INTEGER PRIMARY KEY AUTOINCREMENT,
-            payment_id TEXT UNIQUE NOT NULL,
-            user_id INTEGER NOT NULL,
-            status TEXT NOT NULL,
-            amount_rub REAL NOT NULL,
-            amount_currency REAL,
-            currency_name TEXT,
-            payment_method TEXT,
-            metadata TEXT,
-            created_date TIMESTAMP
-        )
-    """)
+    cursor.execute(_TRANSACTIONS_TABLE_SQL)
 
 
 def create_host(name: str, url: str, user: str, passwd: str, inbound: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             # Check if host with same name and identical parameters already exists
             cursor.execute(
@@ -707,10 +1035,15 @@ def update_host(
     old_name: str, new_name: str, url: str, user: str, passwd: str, inbound: int
 ) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
+            # Take the write lock up front so the existence checks and the
+            # rename cascade below run as one atomic transaction.
+            if not conn.in_transaction:
+                cursor.execute("BEGIN IMMEDIATE")
             cursor.execute("SELECT 1 FROM xui_hosts WHERE host_name = ?", (old_name,))
             if not cursor.fetchone():
+                conn.rollback()
                 logging.warning(f"Host '{old_name}' not found for update.")
                 return False
 
@@ -719,6 +1052,7 @@ def update_host(
                     "SELECT 1 FROM xui_hosts WHERE host_name = ?", (new_name,)
                 )
                 if cursor.fetchone():
+                    conn.rollback()
                     logging.warning(
                         f"Cannot rename host '{old_name}' to '{new_name}': target already exists."
                     )
@@ -776,6 +1110,7 @@ def update_host(
                 )
 
             conn.commit()
+            invalidate_settings_cache()
             logging.info(f"Host '{old_name}' updated to '{new_name}'.")
             return True
     except sqlite3.Error as e:
@@ -785,7 +1120,7 @@ def update_host(
 
 def toggle_host_status(host_name: str, is_enabled: bool):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE xui_hosts SET is_enabled=? WHERE host_name=?",
@@ -799,7 +1134,7 @@ def toggle_host_status(host_name: str, is_enabled: bool):
 
 def delete_host(host_name: str) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             host_slug = _host_slug(host_name)
             cursor.execute("DELETE FROM xui_hosts WHERE host_name = ?", (host_name,))
@@ -823,6 +1158,7 @@ def delete_host(host_name: str) -> bool:
                 (host_name,),
             )
             conn.commit()
+            invalidate_settings_cache()
             logging.info(f"Host '{host_name}' deleted.")
             return True
     except sqlite3.Error as e:
@@ -832,12 +1168,10 @@ def delete_host(host_name: str) -> bool:
 
 def get_host(host_name: str) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM xui_hosts WHERE host_name = ?", (host_name,))
-            result = cursor.fetchone()
-            return dict(result) if result else None
+            return _fetch_dict(cursor)
     except sqlite3.Error as e:
         logging.error(f"Error getting host '{host_name}': {e}")
         return None
@@ -845,15 +1179,13 @@ def get_host(host_name: str) -> dict | None:
 
 def get_all_hosts(only_enabled: bool = False) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             if only_enabled:
                 cursor.execute("SELECT * FROM xui_hosts WHERE is_enabled = 1")
             else:
                 cursor.execute("SELECT * FROM xui_hosts")
-            hosts = cursor.fetchall()
-            return [dict(row) for row in hosts]
+            return _fetch_dicts(cursor)
     except sqlite3.Error as e:
         logging.error(f"Error getting list of all hosts: {e}")
         return []
@@ -866,7 +1198,7 @@ def get_all_hosts(only_enabled: bool = False) -> list[dict]:
 
 def create_mtg_host(name: str, url: str, user: str, passwd: str) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT host_name FROM mtg_hosts WHERE host_name=?", (name,))
             if cursor.fetchone():
@@ -888,7 +1220,7 @@ def update_mtg_host(
     old_name: str, new_name: str, url: str, user: str, passwd: str
 ) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT 1 FROM mtg_hosts WHERE host_name = ?", (old_name,))
             if not cursor.fetchone():
@@ -942,7 +1274,7 @@ def update_mtg_host(
 
 def toggle_mtg_host_status(host_name: str, is_enabled: bool):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE mtg_hosts SET is_enabled=? WHERE host_name=?",
@@ -956,7 +1288,7 @@ def toggle_mtg_host_status(host_name: str, is_enabled: bool):
 
 def delete_mtg_host(host_name: str) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM mtg_hosts WHERE host_name = ?", (host_name,))
             cursor.execute(
@@ -982,12 +1314,10 @@ def delete_mtg_host(host_name: str) -> bool:
 
 def get_mtg_host(host_name: str) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM mtg_hosts WHERE host_name = ?", (host_name,))
-            result = cursor.fetchone()
-            return dict(result) if result else None
+            return _fetch_dict(cursor)
     except sqlite3.Error as e:
         logging.error(f"Error getting MTG host '{host_name}': {e}")
         return None
@@ -995,14 +1325,13 @@ def get_mtg_host(host_name: str) -> dict | None:
 
 def get_all_mtg_hosts(only_enabled: bool = False) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             if only_enabled:
                 cursor.execute("SELECT * FROM mtg_hosts WHERE is_enabled = 1")
             else:
                 cursor.execute("SELECT * FROM mtg_hosts")
-            return [dict(row) for row in cursor.fetchall()]
+            return _fetch_dicts(cursor)
     except sqlite3.Error as e:
         logging.error(f"Error getting MTG hosts: {e}")
         return []
@@ -1011,13 +1340,12 @@ def get_all_mtg_hosts(only_enabled: bool = False) -> list[dict]:
 def get_keys_by_service_type(service_type: str) -> list[dict]:
     """Return all vpn_keys rows that match the given service_type ('xui' or 'mtg')."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT * FROM vpn_keys WHERE service_type = ?", (service_type,)
             )
-            return [dict(row) for row in cursor.fetchall()]
+            return _fetch_dicts(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get keys by service_type '{service_type}': {e}")
         return []
@@ -1028,77 +1356,112 @@ def get_keys_by_service_type(service_type: str) -> list[dict]:
 
 def get_all_keys_with_usernames() -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("""
                 SELECT k.*, u.username, u.subscription_token,
-                       (julianday(k.expiry_date) - julianday('now')) as days_left
+                       CAST(julianday(k.expiry_date) - julianday('now') AS INTEGER) as days_left
                 FROM vpn_keys k
                 LEFT JOIN users u ON k.user_id = u.telegram_id
                 ORDER BY k.created_date DESC
             """)
-            results = [dict(row) for row in cursor.fetchall()]
-
-            # Post-process days_left for better display
-            for res in results:
-                if res["days_left"] is not None:
-                    res["days_left"] = int(res["days_left"])
-
-            return results
+            return _fetch_dicts(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get all keys with usernames: {e}")
         return []
 
 
-def get_all_keys() -> list[dict]:
+def get_all_keys_iter() -> Iterator[dict]:
+    """
+    Yield every key row without materializing the whole table.
+    Consume it on the thread that created it; the read connection is per-thread.
+    """
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
+            cursor.arraysize = 1000
+            cursor.row_factory = None
             cursor.execute("SELECT * FROM vpn_keys")
-            return [dict(row) for row in cursor.fetchall()]
+            columns = [column[0] for column in cursor.description]
+            while rows := cursor.fetchmany():
+                for row in rows:
+                    yield dict(zip(columns, row))
     except sqlite3.Error as e:
-        logging.error(f"Failed to get all keys: {e}")
-        return []
+        logging.error(f"Failed to iterate keys: {e}")
 
 
-def get_setting(key: str) -> str | None:
+def get_all_keys() -> list[dict]:
+    return list(get_all_keys_iter())
+
+
+def get_keys_for_expiry_check(grace_days: int = 2) -> list[dict]:
+    """
+    Keys the expiry notifier can still act on: those expiring after
+    now - grace_days, plus every key on a global plan, since a global
+    subscription's expiry is the earliest across all of the user's keys.
+    """
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT value FROM bot_settings WHERE key = ?", (key,))
-            result = cursor.fetchone()
-            return result[0] if result else None
+            cursor.execute(
+                """
+                SELECT * FROM vpn_keys
+                WHERE julianday(expiry_date) > julianday('now', ?)
+                   OR plan_id IN (SELECT plan_id FROM plans WHERE host_name = 'ALL')
+                """,
+                (f"-{int(grace_days)} days",),
+            )
+            return _fetch_dicts(cursor)
     except sqlite3.Error as e:
-        logging.error(f"Failed to get setting '{key}': {e}")
-        return None
+        logging.error(f"Failed to get keys for expiry check: {e}")
+        return []
+
+
+# bot_settings is read on almost every update but changes rarely, so reads are
+# served from an in-process snapshot. It is loaded lazily, kept in sync by
+# update_setting and dropped by every other writer of the table.
+_settings_cache: dict[str, str | None] | None = None
+_settings_lock = threading.RLock()
+
+
+def _load_settings() -> dict[str, str | None] | None:
+    global _settings_cache
+    with _settings_lock:
+        if _settings_cache is None:
+            try:
+                with _get_ro_conn() as conn:
+                    cursor = conn.cursor()
+                    cursor.execute("SELECT key, value FROM bot_settings")
+                    _settings_cache = dict(cursor.fetchall())
+            except sqlite3.Error as e:
+                logging.error(f"Failed to load settings: {e}")
+        return _settings_cache
+
+
+def invalidate_settings_cache() -> None:
+    global _settings_cache
+    with _settings_lock:
+        _settings_cache = None
+
+
+def get_setting(key: str) -> str | None:
+    settings = _load_settings()
+    return settings.get(key) if settings is not None else None
 
 
 def get_all_settings() -> dict:
-    settings = {}
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            cursor = conn.cursor()
-            cursor.execute("SELECT key, value FROM bot_settings")
-            rows = cursor.fetchall()
-            for row in rows:
-                settings[row["key"]] = row["value"]
-    except sqlite3.Error as e:
-        logging.error(f"Failed to get all settings: {e}")
-    return settings
+    settings = _load_settings()
+    return dict(settings) if settings is not None else {}
 
 
 def update_setting(key: str, value: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _settings_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "INSERT OR REPLACE INTO bot_settings (key, value) VALUES (?, ?)",
-                (key, value),
-            )
+            cursor.execute(_SQL_UPDATE_SETTING, (key, value))
             conn.commit()
+            if _settings_cache is not None:
+                _settings_cache[key] = value
             logging.info(f"Setting '{key}' updated.")
     except sqlite3.Error as e:
         logging.error(f"Failed to update setting '{key}': {e}")
@@ -1112,7 +1475,7 @@ def create_plan(
     host_name: str, plan_name: str, months: int, price: float, service_type: str = "xui"
 ):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT INTO plans (host_name, plan_name, months, price, service_type) VALUES (?, ?, ?, ?, ?)",
@@ -1128,8 +1491,7 @@ def create_plan(
 
 def get_plans_for_host(host_name: str, service_type: str | None = None) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             if service_type:
                 cursor.execute(
@@ -1141,8 +1503,7 @@ def get_plans_for_host(host_name: str, service_type: str | None = None) -> list[
                     "SELECT * FROM plans WHERE host_name = ? ORDER BY months",
                     (host_name,),
                 )
-            plans = cursor.fetchall()
-            return [dict(plan) for plan in plans]
+            return _fetch_dicts(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get plans for host '{host_name}': {e}")
         return []
@@ -1150,12 +1511,10 @@ def get_plans_for_host(host_name: str, service_type: str | None = None) -> list[
 
 def get_plan_by_id(plan_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM plans WHERE plan_id = ?", (plan_id,))
-            plan = cursor.fetchone()
-            return dict(plan) if plan else None
+            cursor.execute(_SQL_GET_PLAN_BY_ID, (plan_id,))
+            return _fetch_dict(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get plan by id '{plan_id}': {e}")
         return None
@@ -1163,7 +1522,7 @@ def get_plan_by_id(plan_id: int) -> dict | None:
 
 def delete_plan(plan_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM plans WHERE plan_id = ?", (plan_id,))
             conn.commit()
@@ -1174,38 +1533,19 @@ def delete_plan(plan_id: int):
 
 def register_user_if_not_exists(telegram_id: int, username: str, referrer_id):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
+            # Existing users only get their username refreshed; legacy users
+            # without a subscription token receive the freshly generated one.
             cursor.execute(
-                "SELECT telegram_id, subscription_token FROM users WHERE telegram_id = ?",
-                (telegram_id,),
+                _SQL_UPSERT_USER,
+                (
+                    telegram_id,
+                    username,
+                    time_utils.get_msk_now(),
+                    referrer_id,
+                ),
             )
-            row = cursor.fetchone()
-            if not row:
-                token = str(uuid.uuid4())
-                cursor.execute(
-                    "INSERT INTO users (telegram_id, username, registration_date, referred_by, subscription_token) VALUES (?, ?, ?, ?, ?)",
-                    (
-                        telegram_id,
-                        username,
-                        time_utils.get_msk_now(),
-                        referrer_id,
-                        token,
-                    ),
-                )
-            else:
-                cursor.execute(
-                    "UPDATE users SET username = ? WHERE telegram_id = ?",
-                    (username, telegram_id),
-                )
-                # Ensure legacy users have a subscription token
-                existing_token = row[1] if len(row) > 1 else None
-                if not existing_token:
-                    new_token = str(uuid.uuid4())
-                    cursor.execute(
-                        "UPDATE users SET subscription_token = ? WHERE telegram_id = ?",
-                        (new_token, telegram_id),
-                    )
             conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to register user {telegram_id}: {e}")
@@ -1213,7 +1553,7 @@ def register_user_if_not_exists(telegram_id: int, username: str, referrer_id):
 
 def get_or_create_subscription_token(telegram_id: int) -> str | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT subscription_token FROM users WHERE telegram_id = ?",
@@ -1222,11 +1562,18 @@ def get_or_create_subscription_token(telegram_id: int) -> str | None:
             row = cursor.fetchone()
             if row and row[0]:
                 return row[0]
-            new_token = str(uuid.uuid4())
+            if not row:
+                return None
+            cursor.execute(
+                "UPDATE users SET subscription_token = lower(hex(randomblob(16))) "
+                "WHERE telegram_id = ?",
+                (telegram_id,),
+            )
             cursor.execute(
-                "UPDATE users SET subscription_token = ? WHERE telegram_id = ?",
-                (new_token, telegram_id),
+                "SELECT subscription_token FROM users WHERE telegram_id = ?",
+                (telegram_id,),
             )
+            new_token = cursor.fetchone()[0]
             conn.commit()
             return new_token
     except sqlite3.Error as e:
@@ -1236,25 +1583,46 @@ def get_or_create_subscription_token(telegram_id: int) -> str | None:
         return None
 
 
-def add_to_referral_balance(user_id: int, amount: float):
+# Numeric users columns that apply_user_delta may increment.
+_USER_DELTA_COLUMNS = frozenset(
+    {"referral_balance", "referral_balance_all", "total_spent", "total_months"}
+)
+
+
+def apply_user_delta(user_id: int, **deltas: float) -> bool:
+    """Add several amounts to a user's counters in a single UPDATE."""
+    unknown = set(deltas) - _USER_DELTA_COLUMNS
+    if unknown:
+        logging.error(f"Refusing to update unsupported user columns: {sorted(unknown)}")
+        return False
+    if not deltas:
+        return True
+    # Sorted so the same set of columns always yields the same cached statement.
+    columns = sorted(deltas)
+    assignments = ", ".join(f"{column} = {column} + ?" for column in columns)
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
-            # referral_balance     — текущий выводимый баланс (сбрасывается при выводе)
-            # referral_balance_all — lifetime-счётчик всего заработанного (никогда не сбрасывается)
             cursor.execute(
-                "UPDATE users SET referral_balance = referral_balance + ?, "
-                "referral_balance_all = referral_balance_all + ? WHERE telegram_id = ?",
-                (amount, amount, user_id),
+                f"UPDATE users SET {assignments} WHERE telegram_id = ?",
+                (*(deltas[column] for column in columns), user_id),
             )
             conn.commit()
+            return True
     except sqlite3.Error as e:
-        logging.error(f"Failed to add to referral balance for user {user_id}: {e}")
+        logging.error(f"Failed to update counters for user {user_id}: {e}")
+        return False
+
+
+def add_to_referral_balance(user_id: int, amount: float):
+    # referral_balance     — текущий выводимый баланс (сбрасывается при выводе)
+    # referral_balance_all — lifetime-счётчик всего заработанного (никогда не сбрасывается)
+    apply_user_delta(user_id, referral_balance=amount, referral_balance_all=amount)
 
 
 def set_referral_balance(user_id: int, value: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE users SET referral_balance = ? WHERE telegram_id = ?",
@@ -1267,7 +1635,7 @@ def set_referral_balance(user_id: int, value: float):
 
 def set_referral_balance_all(user_id: int, value: float):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE users SET referral_balance_all = ? WHERE telegram_id = ?",
@@ -1280,7 +1648,7 @@ def set_referral_balance_all(user_id: int, value: float):
 
 def get_referral_balance(user_id: int) -> float:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT referral_balance FROM users WHERE telegram_id = ?", (user_id,)
@@ -1294,8 +1662,9 @@ def get_referral_balance(user_id: int) -> float:
 
 def get_referral_count(user_id: int) -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
+            # Answered from idx_users_referred_by alone (covering index range scan).
             cursor.execute(
                 "SELECT COUNT(*) FROM users WHERE referred_by = ?", (user_id,)
             )
@@ -1307,12 +1676,10 @@ def get_referral_count(user_id: int) -> int:
 
 def get_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users WHERE telegram_id = ?", (telegram_id,))
-            user_data = cursor.fetchone()
-            return dict(user_data) if user_data else None
+            cursor.execute(_SQL_GET_USER, (telegram_id,))
+            return _fetch_dict(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get user {telegram_id}: {e}")
         return None
@@ -1320,12 +1687,10 @@ def get_user(telegram_id: int):
 
 def get_user_by_token(token: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM users WHERE subscription_token = ?", (token,))
-            user_data = cursor.fetchone()
-            return dict(user_data) if user_data else None
+            cursor.execute(_SQL_GET_USER_BY_TOKEN, (token,))
+            return _fetch_dict(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get user by token: {e}")
         return None
@@ -1333,7 +1698,7 @@ def get_user_by_token(token: str):
 
 def set_terms_agreed(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE users SET agreed_to_terms = 1 WHERE telegram_id = ?",
@@ -1346,21 +1711,14 @@ def set_terms_agreed(telegram_id: int):
 
 
 def update_user_stats(telegram_id: int, amount_spent: float, months_purchased: int):
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE users SET total_spent = total_spent + ?, total_months = total_months + ? WHERE telegram_id = ?",
-                (amount_spent, months_purchased, telegram_id),
-            )
-            conn.commit()
-    except sqlite3.Error as e:
-        logging.error(f"Failed to update user stats for {telegram_id}: {e}")
+    apply_user_delta(
+        telegram_id, total_spent=amount_spent, total_months=months_purchased
+    )
 
 
 def get_user_count() -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM users")
             return cursor.fetchone()[0] or 0
@@ -1371,7 +1729,7 @@ def get_user_count() -> int:
 
 def get_total_keys_count() -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT COUNT(*) FROM vpn_keys")
             return cursor.fetchone()[0] or 0
@@ -1382,7 +1740,7 @@ def get_total_keys_count() -> int:
 
 def get_total_spent_sum() -> float:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT SUM(total_spent) FROM users")
             return cursor.fetchone()[0] or 0.0
@@ -1395,26 +1753,20 @@ def create_pending_transaction(
     payment_id: str, user_id: int, amount_rub: float, metadata: dict
 ) -> int:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "SELECT username FROM users WHERE telegram_id = ?", (user_id,)
-            )
+            cursor.execute(_SQL_GET_USERNAME, (user_id,))
             user_row = cursor.fetchone()
             username = user_row[0] if user_row else None
             cursor.execute(
-                """
-                INSERT INTO transactions
-                (username, payment_id, user_id, status, amount_rub, metadata, created_date)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-                """,
+                _SQL_INSERT_PENDING_TRANSACTION,
                 (
                     username,
                     payment_id,
                     user_id,
                     "pending",
                     amount_rub,
-                    json.dumps(metadata),
+                    _dump_metadata(metadata),
                     time_utils.get_msk_now(),
                 ),
             )
@@ -1438,55 +1790,40 @@ def reserve_pending_transaction(
     Returns metadata if the transaction was reserved, otherwise None.
     """
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                "SELECT metadata FROM transactions WHERE payment_id = ? AND status = 'pending'",
-                (payment_id,),
-            )
-            row = cursor.fetchone()
-            if not row:
-                return None
-
-            metadata_raw = row["metadata"]
-            if metadata is None:
-                try:
-                    metadata_to_store = json.loads(metadata_raw) if metadata_raw else {}
-                except json.JSONDecodeError:
-                    metadata_to_store = {}
-            else:
-                metadata_to_store = metadata
-
-            cursor.execute(
-                """
-                UPDATE transactions
-                SET status = 'processing',
-                    amount_currency = COALESCE(?, amount_currency),
-                    currency_name = COALESCE(?, currency_name),
-                    payment_method = COALESCE(?, payment_method),
-                    metadata = ?,
-                    created_date = COALESCE(created_date, ?),
-                    username = COALESCE(
-                        username,
-                        (SELECT username FROM users WHERE telegram_id = transactions.user_id)
-                    )
-                WHERE payment_id = ? AND status = 'pending'
-                """,
+                _SQL_RESERVE_PENDING_TRANSACTION,
                 (
                     amount_currency,
                     currency_name,
                     payment_method,
-                    json.dumps(metadata_to_store),
+                    None if metadata is None else _dump_metadata(metadata),
                     time_utils.get_msk_now(),
                     payment_id,
                 ),
             )
-            if cursor.rowcount != 1:
+            if _HAS_RETURNING:
+                rows = cursor.fetchall()
+            elif cursor.rowcount == 1:
+                cursor.execute(
+                    "SELECT metadata FROM transactions WHERE payment_id = ?",
+                    (payment_id,),
+                )
+                rows = cursor.fetchall()
+            else:
+                rows = []
+            if len(rows) != 1:
                 conn.rollback()
                 return None
             conn.commit()
-            return metadata_to_store
+
+            if metadata is not None:
+                return metadata
+            try:
+                return _load_metadata(rows[0][0])
+            except json.JSONDecodeError:
+                return {}
     except sqlite3.Error as e:
         logging.error(f"Failed to reserve pending transaction {payment_id}: {e}")
         return None
@@ -1508,7 +1845,7 @@ def finalize_reserved_transaction(
     """
     target_status = "paid" if success else "pending"
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -1522,7 +1859,7 @@ def finalize_reserved_transaction(
                 """,
                 (
                     target_status,
-                    json.dumps(metadata) if metadata is not None else None,
+                    _dump_metadata(metadata) if metadata is not None else None,
                     payment_method,
                     amount_currency,
                     currency_name,
@@ -1554,7 +1891,7 @@ def log_transaction(
     metadata: str,
 ):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """INSERT INTO transactions
@@ -1586,50 +1923,30 @@ def get_paginated_transactions(
     transactions = []
     total = 0
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
 
             cursor.execute("SELECT COUNT(*) FROM transactions")
             total = cursor.fetchone()[0]
 
-            query = (
-                "SELECT * FROM transactions ORDER BY created_date DESC LIMIT ? OFFSET ?"
-            )
-            cursor.execute(query, (per_page, offset))
-
-            for row in cursor.fetchall():
-                transaction_dict = dict(row)
-
-                metadata_str = transaction_dict.get("metadata")
-                if metadata_str:
-                    try:
-                        metadata = json.loads(metadata_str)
-                        transaction_dict["host_name"] = metadata.get("host_name", "N/A")
-                        transaction_dict["plan_name"] = metadata.get("plan_name", "N/A")
-                    except json.JSONDecodeError:
-                        transaction_dict["host_name"] = "Error"
-                        transaction_dict["plan_name"] = "Error"
+            # One statement per page: host/plan come from the metadata JSON and
+            # the subscription expiry from a correlated MAX over the user's keys
+            # (restricted to the purchased host when the metadata names one).
+            cursor.execute(_SQL_PAGINATED_TRANSACTIONS, (per_page, offset))
+            for row in _fetch_dicts(cursor):
+                metadata_valid = row.pop("metadata_valid")
+                meta_host_name = row.pop("meta_host_name")
+                meta_plan_name = row.pop("meta_plan_name")
+                if not row.get("metadata"):
+                    row["host_name"] = "N/A"
+                    row["plan_name"] = "N/A"
+                elif not metadata_valid:
+                    row["host_name"] = "Error"
+                    row["plan_name"] = "Error"
                 else:
-                    transaction_dict["host_name"] = "N/A"
-                    transaction_dict["plan_name"] = "N/A"
-
-                try:
-                    expiry_query = (
-                        "SELECT MAX(expiry_date) FROM vpn_keys WHERE user_id = ?"
-                    )
-                    expiry_params = [transaction_dict.get("user_id")]
-                    host_name = transaction_dict.get("host_name")
-                    if host_name and host_name not in ("N/A", "Error"):
-                        expiry_query += " AND host_name = ?"
-                        expiry_params.append(host_name)
-
-                    cursor.execute(expiry_query, tuple(expiry_params))
-                    transaction_dict["subscription_expires_at"] = cursor.fetchone()[0]
-                except sqlite3.Error:
-                    transaction_dict["subscription_expires_at"] = None
-
-                transactions.append(transaction_dict)
+                    row["host_name"] = meta_host_name or "N/A"
+                    row["plan_name"] = meta_plan_name or "N/A"
+                transactions.append(row)
 
     except sqlite3.Error as e:
         logging.error(f"Failed to get paginated transactions: {e}")
@@ -1639,7 +1956,7 @@ def get_paginated_transactions(
 
 def set_trial_used(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE users SET trial_used = 1 WHERE telegram_id = ?", (telegram_id,)
@@ -1661,7 +1978,7 @@ def add_new_key(
     service_type: str = "xui",
 ):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             expiry_date = time_utils.from_timestamp_ms(expiry_timestamp_ms)
             created_date = time_utils.get_msk_now()
@@ -1682,9 +1999,7 @@ def add_new_key(
             new_key_id = cursor.lastrowid
 
             # Ensure key is removed from missing list if it was there
-            cursor.execute(
-                "DELETE FROM vpn_keys_missing WHERE key_email = ?", (key_email,)
-            )
+            cursor.execute(_SQL_DELETE_MISSING_KEY, (key_email,))
 
             conn.commit()
             return new_key_id
@@ -1714,8 +2029,7 @@ def add_new_key(
             in message
         ):
             try:
-                with sqlite3.connect(DB_FILE) as conn:
-                    conn.row_factory = sqlite3.Row
+                with _get_ro_conn() as conn:
                     cursor = conn.cursor()
                     cursor.execute(
                         "SELECT key_id, key_email FROM vpn_keys WHERE user_id = ? AND host_name = ? AND plan_id > 0 ORDER BY key_id DESC LIMIT 1",
@@ -1761,7 +2075,7 @@ def update_key_by_email(
     plan_id: int = 0,
 ):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             expiry_date = time_utils.from_timestamp_ms(expiry_timestamp_ms)
             if connection_string:
@@ -1781,9 +2095,7 @@ def update_key_by_email(
                     "UPDATE vpn_keys SET host_name = ?, xui_client_uuid = ?, expiry_date = ?, plan_id = ? WHERE key_email = ?",
                     (host_name, xui_client_uuid, expiry_date, plan_id, key_email),
                 )
-            cursor.execute(
-                "DELETE FROM vpn_keys_missing WHERE key_email = ?", (key_email,)
-            )
+            cursor.execute(_SQL_DELETE_MISSING_KEY, (key_email,))
             conn.commit()
             return True
     except sqlite3.Error as e:
@@ -1791,9 +2103,43 @@ def update_key_by_email(
         return False
 
 
+def update_keys_by_email(
+    rows: list[tuple[str, str, str, int, str | None, int]],
+):
+    """
+    Batch form of update_key_by_email: rows of (key_email, host_name,
+    xui_client_uuid, expiry_timestamp_ms, connection_string, plan_id),
+    written with one executemany in a single transaction.
+    """
+    if not rows:
+        return
+    params = [
+        (
+            host_name,
+            client_uuid,
+            time_utils.from_timestamp_ms(expiry_ms),
+            conn_str,
+            plan_id,
+            key_email,
+        )
+        for key_email, host_name, client_uuid, expiry_ms, conn_str, plan_id in rows
+    ]
+    try:
+        with _write_lock, _get_rw_conn() as conn:
+            cursor = conn.cursor()
+            cursor.executemany(
+                "UPDATE vpn_keys SET host_name = ?, xui_client_uuid = ?, expiry_date = ?, connection_string = COALESCE(NULLIF(?, ''), connection_string), plan_id = ? WHERE key_email = ?",
+                params,
+            )
+            cursor.executemany(_SQL_DELETE_MISSING_KEY, [(row[0],) for row in rows])
+            conn.commit()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to update {len(rows)} keys by email: {e}")
+
+
 def mark_key_missing(key_email: str, first_seen: str, host_name: str | None = None):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT OR IGNORE INTO vpn_keys_missing (key_email, host_name, first_seen) VALUES (?, ?, ?)",
@@ -1806,11 +2152,10 @@ def mark_key_missing(key_email: str, first_seen: str, host_name: str | None = No
 
 def get_missing_keys():
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys_missing")
-            return [dict(r) for r in cursor.fetchall()]
+            return _fetch_dicts(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get missing keys: {e}")
         return []
@@ -1818,11 +2163,9 @@ def get_missing_keys():
 
 def purge_missing_key(key_email: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "DELETE FROM vpn_keys_missing WHERE key_email = ?", (key_email,)
-            )
+            cursor.execute(_SQL_DELETE_MISSING_KEY, (key_email,))
             conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to purge missing key {key_email}: {e}")
@@ -1830,14 +2173,10 @@ def purge_missing_key(key_email: str):
 
 def get_user_keys(user_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "SELECT * FROM vpn_keys WHERE user_id = ? ORDER BY key_id", (user_id,)
-            )
-            keys = cursor.fetchall()
-            return [dict(key) for key in keys]
+            cursor.execute(_SQL_GET_USER_KEYS, (user_id,))
+            return _fetch_dicts(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get keys for user {user_id}: {e}")
         return []
@@ -1845,12 +2184,10 @@ def get_user_keys(user_id: int):
 
 def get_key_by_id(key_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM vpn_keys WHERE key_id = ?", (key_id,))
-            key_data = cursor.fetchone()
-            return dict(key_data) if key_data else None
+            cursor.execute(_SQL_GET_KEY_BY_ID, (key_id,))
+            return _fetch_dict(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get key by ID {key_id}: {e}")
         return None
@@ -1858,12 +2195,10 @@ def get_key_by_id(key_id: int):
 
 def get_key_by_email(key_email: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT * FROM vpn_keys WHERE key_email = ?", (key_email,))
-            key_data = cursor.fetchone()
-            return dict(key_data) if key_data else None
+            cursor.execute(_SQL_GET_KEY_BY_EMAIL, (key_email,))
+            return _fetch_dict(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get key by email {key_email}: {e}")
         return None
@@ -1872,15 +2207,10 @@ def get_key_by_email(key_email: str):
 def get_user_paid_keys(user_id: int):
     """Get only paid keys for user (plan_id > 0)"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "SELECT * FROM vpn_keys WHERE user_id = ? AND plan_id > 0 ORDER BY key_id",
-                (user_id,),
-            )
-            keys = cursor.fetchall()
-            return [dict(key) for key in keys]
+            cursor.execute(_SQL_GET_USER_PAID_KEYS, (user_id,))
+            return _fetch_dicts(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get paid keys for user {user_id}: {e}")
         return []
@@ -1889,15 +2219,10 @@ def get_user_paid_keys(user_id: int):
 def get_user_trial_keys(user_id: int):
     """Get only trial keys for user (plan_id = 0)"""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "SELECT * FROM vpn_keys WHERE user_id = ? AND plan_id = 0 ORDER BY key_id",
-                (user_id,),
-            )
-            keys = cursor.fetchall()
-            return [dict(key) for key in keys]
+            cursor.execute(_SQL_GET_USER_TRIAL_KEYS, (user_id,))
+            return _fetch_dicts(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get trial keys for user {user_id}: {e}")
         return []
@@ -1910,7 +2235,7 @@ def update_key_info(
     xui_client_uuid: str | None = None,
 ):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             fields = ["expiry_date = ?"]
             values: list = [expiry_date]
@@ -1932,7 +2257,7 @@ def update_key_info(
 
 def update_key_connection_string(key_id: int, connection_string: str):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE vpn_keys SET connection_string = ? WHERE key_id = ?",
@@ -1945,12 +2270,9 @@ def update_key_connection_string(key_id: int, connection_string: str):
 
 def update_key_plan_id(key_id: int, plan_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "UPDATE vpn_keys SET plan_id = ? WHERE key_id = ?",
-                (int(plan_id), int(key_id)),
-            )
+            cursor.execute(_SQL_UPDATE_KEY_PLAN_ID, (int(plan_id), int(key_id)))
             conn.commit()
     except sqlite3.Error as e:
         logging.error(f"Failed to update plan_id for key {key_id}: {e}")
@@ -1959,63 +2281,97 @@ def update_key_plan_id(key_id: int, plan_id: int):
 import re
 
 
+# Matches both xui (user123-key5-ru) and MTG (user123key5mtg) key emails.
+_KEY_NUMBER_RE = re.compile(r"user(\d+)(?:-key(\d+)-|key(\d+)mtg)")
+
+
+def _key_number(email: str | None, user_id: int) -> int | None:
+    """SQL scalar function: the N from a key email of user_id, else NULL."""
+    for match in _KEY_NUMBER_RE.finditer(email or ""):
+        if int(match.group(1)) == user_id:
+            return int(match.group(2) or match.group(3))
+    return None
+
+
 def get_next_key_number(user_id: int) -> int:
     """
     Safely determine the next key number for a user to avoid collisions.
     Handles both xui format (user123-key5-ru) and MTG format (user123key5mtg).
     """
-    keys = get_user_keys(user_id)
-    max_num = 0
-    # xui keys: user{id}-key{N}-{host}
-    xui_pattern = re.compile(rf"user{user_id}-key(\d+)-")
-    # MTG keys: user{id}key{N}mtg
-    mtg_pattern = re.compile(rf"user{user_id}key(\d+)mtg")
-
-    for key in keys:
-        email = key.get("key_email", "")
-        for pattern in (xui_pattern, mtg_pattern):
-            match = pattern.search(email)
-            if match:
-                try:
-                    num = int(match.group(1))
-                    if num > max_num:
-                        max_num = num
-                except ValueError:
-                    pass
-                break
-
-    return max_num + 1
+    try:
+        with _get_ro_conn() as conn:
+            row = conn.execute(
+                """
+                SELECT COALESCE(MAX(key_number(key_email, user_id)), 0) + 1
+                FROM vpn_keys
+                WHERE user_id = ?
+                """,
+                (user_id,),
+            ).fetchone()
+            return int(row[0])
+    except sqlite3.Error as e:
+        logging.error(f"Failed to compute next key number for user {user_id}: {e}")
+        return 1
 
 
 def get_keys_for_host(host_name: str) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("SELECT * FROM vpn_keys WHERE host_name = ?", (host_name,))
-            keys = cursor.fetchall()
-            return [dict(key) for key in keys]
+            return _fetch_dicts(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get keys for host '{host_name}': {e}")
         return []
 
 
-def get_all_vpn_users():
+def get_keys_grouped_by_host() -> dict[str, list[dict]]:
+    """
+    All keys in one pass, bucketed by host_name, for per-host sync loops.
+    Each row also carries expiry_ms: expiry_date as UTC epoch milliseconds
+    (naive values read as UTC, like time_utils.parse_iso_to_msk), or None
+    when the stored date cannot be parsed.
+    """
+    keys_by_host: dict[str, list[dict]] = {}
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("SELECT DISTINCT user_id FROM vpn_keys")
-            users = cursor.fetchall()
-            return [dict(user) for user in users]
+            cursor.execute(
+                """
+                SELECT *,
+                       CAST(round((julianday(expiry_date) - 2440587.5) * 86400000)
+                            AS INTEGER) AS expiry_ms
+                FROM vpn_keys
+                """
+            )
+            for key in _fetch_dicts(cursor):
+                keys_by_host.setdefault(key["host_name"], []).append(key)
     except sqlite3.Error as e:
-        logging.error(f"Failed to get all vpn users: {e}")
+        logging.error(f"Failed to get keys grouped by host: {e}")
+    return keys_by_host
+
+
+def get_key_expiries_for_host(host_name: str) -> list[dict]:
+    """
+    Narrow form of get_keys_for_host for the panel enforce/repair loops,
+    which only need identity, expiry and plan of each key.
+    """
+    try:
+        with _get_ro_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT key_id, key_email, expiry_date, plan_id FROM vpn_keys WHERE host_name = ?",
+                (host_name,),
+            )
+            return _fetch_dicts(cursor)
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get key expiries for host '{host_name}': {e}")
         return []
 
 
 def update_key_status_from_server(key_email: str, xui_client_data):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             if xui_client_data:
                 expiry_date = time_utils.from_timestamp_ms(xui_client_data.expiry_time)
@@ -2025,9 +2381,7 @@ def update_key_status_from_server(key_email: str, xui_client_data):
                 )
 
                 # Key found, remove from missing
-                cursor.execute(
-                    "DELETE FROM vpn_keys_missing WHERE key_email = ?", (key_email,)
-                )
+                cursor.execute(_SQL_DELETE_MISSING_KEY, (key_email,))
             else:
                 cursor.execute("DELETE FROM vpn_keys WHERE key_email = ?", (key_email,))
             conn.commit()
@@ -2035,32 +2389,78 @@ def update_key_status_from_server(key_email: str, xui_client_data):
         logging.error(f"Failed to update key status for {key_email}: {e}")
 
 
+def apply_key_sync_changes(
+    key_updates: list[tuple[int, datetime | None, str | None]],
+    uuid_updates: list[tuple[str, datetime, str]],
+    missing_rows: list[tuple[str, str, str | None]] = (),
+):
+    """
+    Write one host's panel sync results in a single transaction.
+    key_updates are (key_id, expiry_date, connection_string) rows where a None
+    (or empty) field keeps the stored value; uuid_updates are
+    (xui_client_uuid, expiry_date, key_email) rows for keys found again;
+    missing_rows are (key_email, first_seen, host_name) rows for keys not found.
+    """
+    if not key_updates and not uuid_updates and not missing_rows:
+        return
+    try:
+        with _write_lock, _get_rw_conn() as conn:
+            cursor = conn.cursor()
+            if key_updates:
+                cursor.executemany(
+                    """
+                    UPDATE vpn_keys
+                    SET expiry_date = COALESCE(?, expiry_date),
+                        connection_string = COALESCE(NULLIF(?, ''), connection_string)
+                    WHERE key_id = ?
+                    """,
+                    [
+                        (expiry, conn_str, key_id)
+                        for key_id, expiry, conn_str in key_updates
+                    ],
+                )
+            if uuid_updates:
+                cursor.executemany(
+                    "UPDATE vpn_keys SET xui_client_uuid = ?, expiry_date = ? WHERE key_email = ?",
+                    uuid_updates,
+                )
+                cursor.executemany(
+                    _SQL_DELETE_MISSING_KEY, [(row[2],) for row in uuid_updates]
+                )
+            if missing_rows:
+                cursor.executemany(
+                    "INSERT OR IGNORE INTO vpn_keys_missing (key_email, first_seen, host_name) VALUES (?, ?, ?)",
+                    missing_rows,
+                )
+            conn.commit()
+    except sqlite3.Error as e:
+        total = len(key_updates) + len(uuid_updates) + len(missing_rows)
+        logging.error(f"Failed to apply sync changes for {total} keys: {e}")
+
+
 def get_daily_stats_for_charts(days: int = 30) -> dict:
     stats = {"users": {}, "keys": {}}
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            query_users = """
-                SELECT date(registration_date) as day, COUNT(*)
+            since = f"-{days} days"
+            cursor.execute(
+                """
+                SELECT 'users' AS kind, date(registration_date) AS day, COUNT(*)
                 FROM users
                 WHERE registration_date >= date('now', ?)
                 GROUP BY day
-                ORDER BY day;
-            """
-            cursor.execute(query_users, (f"-{days} days",))
-            for row in cursor.fetchall():
-                stats["users"][row[0]] = row[1]
-
-            query_keys = """
-                SELECT date(created_date) as day, COUNT(*)
+                UNION ALL
+                SELECT 'keys', date(created_date) AS day, COUNT(*)
                 FROM vpn_keys
                 WHERE created_date >= date('now', ?)
                 GROUP BY day
-                ORDER BY day;
-            """
-            cursor.execute(query_keys, (f"-{days} days",))
-            for row in cursor.fetchall():
-                stats["keys"][row[0]] = row[1]
+                ORDER BY kind, day;
+                """,
+                (since, since),
+            )
+            for kind, day, count in cursor:
+                stats[kind][day] = count
     except sqlite3.Error as e:
         logging.error(f"Failed to get daily stats for charts: {e}")
     return stats
@@ -2069,26 +2469,10 @@ def get_daily_stats_for_charts(days: int = 30) -> dict:
 def get_recent_transactions(limit: int = 15) -> list[dict]:
     transactions = []
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            query = """
-                SELECT
-                    t.transaction_id,
-                    t.payment_id,
-                    t.user_id,
-                    t.username,
-                    t.status,
-                    t.amount_rub,
-                    t.payment_method,
-                    t.metadata,
-                    t.created_date
-                FROM transactions t
-                ORDER BY t.created_date DESC
-                LIMIT ?;
-            """
-            cursor.execute(query, (limit,))
-            transactions = [dict(row) for row in cursor.fetchall()]
+            cursor.execute(_SQL_RECENT_TRANSACTIONS, (limit,))
+            transactions = _fetch_dicts(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get recent transactions: {e}")
     return transactions
@@ -2099,12 +2483,9 @@ def add_support_thread(user_id: int, thread_id: int):
         logger.warning(f"Attempted to add None thread_id for user {user_id}. Ignoring.")
         return
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                "INSERT OR REPLACE INTO support_threads (user_id, thread_id) VALUES (?, ?)",
-                (user_id, thread_id),
-            )
+            cursor.execute(_SQL_UPSERT_SUPPORT_THREAD, (user_id, thread_id))
             now = _now_iso()
             cursor.execute(
                 """
@@ -2128,7 +2509,7 @@ def add_support_thread(user_id: int, thread_id: int):
 
 def delete_support_thread(user_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM support_threads WHERE user_id = ?", (user_id,))
             cursor.execute(
@@ -2151,19 +2532,11 @@ def delete_support_thread(user_id: int):
 
 def get_support_thread_id(user_id: int) -> int | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT COALESCE(
-                    (SELECT current_thread_id FROM support_tickets WHERE user_id = ?),
-                    (SELECT thread_id FROM support_threads WHERE user_id = ?)
-                )
-                """,
-                (user_id, user_id),
-            )
-            result = cursor.fetchone()
-            return result[0] if result else None
+            cursor.row_factory = _first_column
+            cursor.execute(_SQL_GET_SUPPORT_THREAD_ID, (user_id, user_id))
+            return cursor.fetchone()
     except sqlite3.Error as e:
         logging.error(f"Failed to get support thread_id for user {user_id}: {e}")
         return None
@@ -2171,19 +2544,11 @@ def get_support_thread_id(user_id: int) -> int | None:
 
 def get_user_id_by_thread(thread_id: int) -> int | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute(
-                """
-                SELECT COALESCE(
-                    (SELECT user_id FROM support_tickets WHERE current_thread_id = ?),
-                    (SELECT user_id FROM support_threads WHERE thread_id = ?)
-                )
-                """,
-                (thread_id, thread_id),
-            )
-            result = cursor.fetchone()
-            return result[0] if result else None
+            cursor.row_factory = _first_column
+            cursor.execute(_SQL_GET_USER_ID_BY_THREAD, (thread_id, thread_id))
+            return cursor.fetchone()
     except sqlite3.Error as e:
         logging.error(f"Failed to get user_id for thread {thread_id}: {e}")
         return None
@@ -2191,14 +2556,12 @@ def get_user_id_by_thread(thread_id: int) -> int | None:
 
 def get_support_ticket(user_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT * FROM support_tickets WHERE user_id = ?", (user_id,)
             )
-            row = cursor.fetchone()
-            return dict(row) if row else None
+            return _fetch_dict(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get support ticket for user {user_id}: {e}")
         return None
@@ -2206,14 +2569,12 @@ def get_support_ticket(user_id: int) -> dict | None:
 
 def get_support_ticket_by_id(ticket_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT * FROM support_tickets WHERE ticket_id = ?", (ticket_id,)
             )
-            row = cursor.fetchone()
-            return dict(row) if row else None
+            return _fetch_dict(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get support ticket {ticket_id}: {e}")
         return None
@@ -2221,15 +2582,13 @@ def get_support_ticket_by_id(ticket_id: int) -> dict | None:
 
 def get_support_ticket_by_thread(thread_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT * FROM support_tickets WHERE current_thread_id = ?",
                 (thread_id,),
             )
-            row = cursor.fetchone()
-            return dict(row) if row else None
+            return _fetch_dict(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get support ticket by thread {thread_id}: {e}")
         return None
@@ -2242,8 +2601,7 @@ def ensure_support_ticket(
 ) -> dict | None:
     now = _now_iso()
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -2258,10 +2616,7 @@ def ensure_support_ticket(
                 (user_id, username, thread_id, now, now),
             )
             if thread_id is not None:
-                cursor.execute(
-                    "INSERT OR REPLACE INTO support_threads (user_id, thread_id) VALUES (?, ?)",
-                    (user_id, thread_id),
-                )
+                cursor.execute(_SQL_UPSERT_SUPPORT_THREAD, (user_id, thread_id))
                 cursor.execute(
                     """
                     UPDATE support_tickets
@@ -2274,8 +2629,7 @@ def ensure_support_ticket(
             cursor.execute(
                 "SELECT * FROM support_tickets WHERE user_id = ?", (user_id,)
             )
-            row = cursor.fetchone()
-            return dict(row) if row else None
+            return _fetch_dict(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to ensure support ticket for user {user_id}: {e}")
         return None
@@ -2289,7 +2643,7 @@ def bind_support_thread(
 ):
     now = _now_iso()
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -2308,10 +2662,7 @@ def bind_support_thread(
                 """,
                 (user_id, username, thread_id, now, now, 1 if reopened else 0),
             )
-            cursor.execute(
-                "INSERT OR REPLACE INTO support_threads (user_id, thread_id) VALUES (?, ?)",
-                (user_id, thread_id),
-            )
+            cursor.execute(_SQL_UPSERT_SUPPORT_THREAD, (user_id, thread_id))
             conn.commit()
     except sqlite3.Error as e:
         logging.error(
@@ -2321,7 +2672,7 @@ def bind_support_thread(
 
 def mark_support_ticket_closed(user_id: int, error_text: str | None = None):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -2341,7 +2692,7 @@ def mark_support_ticket_closed(user_id: int, error_text: str | None = None):
 
 def mark_support_ticket_waiting_reopen(user_id: int, error_text: str | None = None):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM support_threads WHERE user_id = ?", (user_id,))
             cursor.execute(
@@ -2378,7 +2729,7 @@ def log_support_message(
 ) -> int | None:
     now = _now_iso()
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -2434,7 +2785,7 @@ def update_support_message_delivery(
     message_log_id: int, status: str, error_text: str | None = None
 ):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -2471,8 +2822,7 @@ def update_support_message_delivery(
 
 def get_support_tickets(limit: int = 200) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -2497,7 +2847,7 @@ def get_support_tickets(limit: int = 200) -> list[dict]:
                 """,
                 (limit,),
             )
-            return [dict(row) for row in cursor.fetchall()]
+            return _fetch_dicts(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get support tickets: {e}")
         return []
@@ -2505,8 +2855,7 @@ def get_support_tickets(limit: int = 200) -> list[dict]:
 
 def get_support_messages(ticket_id: int, limit: int = 300) -> list[dict]:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 """
@@ -2518,7 +2867,7 @@ def get_support_messages(ticket_id: int, limit: int = 300) -> list[dict]:
                 """,
                 (ticket_id, limit),
             )
-            rows = [dict(row) for row in cursor.fetchall()]
+            rows = _fetch_dicts(cursor)
             rows.reverse()
             return rows
     except sqlite3.Error as e:
@@ -2528,35 +2877,111 @@ def get_support_messages(ticket_id: int, limit: int = 300) -> list[dict]:
 
 def get_latest_transaction(user_id: int) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT * FROM transactions WHERE user_id = ? ORDER BY created_date DESC LIMIT 1",
                 (user_id,),
             )
-            transaction = cursor.fetchone()
-            return dict(transaction) if transaction else None
+            return _fetch_dict(cursor)
     except sqlite3.Error as e:
         logging.error(f"Failed to get latest transaction for user {user_id}: {e}")
         return None
 
 
-def get_all_users() -> list[dict]:
+def get_transaction_status(payment_id: str) -> str | None:
+    try:
+        with _get_ro_conn() as conn:
+            cursor = conn.cursor()
+            cursor.row_factory = _first_column
+            cursor.execute(
+                "SELECT status FROM transactions WHERE payment_id = ?", (payment_id,)
+            )
+            return cursor.fetchone()
+    except sqlite3.Error as e:
+        logging.error(f"Failed to get transaction status for {payment_id}: {e}")
+        return None
+
+
+# ─────────────────────────────────────────────
+# Processed payment webhooks (idempotency markers)
+# ─────────────────────────────────────────────
+
+
+def ensure_processed_webhooks_table():
+    try:
+        with _write_lock, _get_rw_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                CREATE TABLE IF NOT EXISTS processed_webhooks (
+                    provider TEXT NOT NULL,
+                    external_id TEXT NOT NULL,
+                    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                    PRIMARY KEY (provider, external_id)
+                )
+                """)
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.error(f"Failed to ensure processed_webhooks table: {e}")
+
+
+def is_webhook_processed(provider: str, external_id: str) -> bool:
+    try:
+        with _get_ro_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT 1 FROM processed_webhooks WHERE provider = ? AND external_id = ?",
+                (provider, external_id),
+            )
+            return cursor.fetchone() is not None
+    except sqlite3.Error as e:
+        logger.error(
+            f"Failed to check webhook processed for {provider}:{external_id}: {e}"
+        )
+        return False
+
+
+def set_webhook_processed(provider: str, external_id: str) -> None:
+    try:
+        with _write_lock, _get_rw_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "INSERT OR IGNORE INTO processed_webhooks (provider, external_id) VALUES (?, ?)",
+                (provider, external_id),
+            )
+            conn.commit()
+    except sqlite3.Error as e:
+        logger.error(
+            f"Failed to set webhook processed for {provider}:{external_id}: {e}"
+        )
+
+
+def iter_all_users() -> Iterator[dict]:
+    """
+    Yield every user, newest first, without materializing the whole table.
+    Same threading rule as get_all_keys_iter.
+    """
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
+            cursor.arraysize = 1000
+            cursor.row_factory = None
             cursor.execute("SELECT * FROM users ORDER BY registration_date DESC")
-            return [dict(row) for row in cursor.fetchall()]
+            columns = [column[0] for column in cursor.description]
+            while rows := cursor.fetchmany():
+                for row in rows:
+                    yield dict(zip(columns, row))
     except sqlite3.Error as e:
-        logging.error(f"Failed to get all users: {e}")
-        return []
+        logging.error(f"Failed to iterate users: {e}")
+
+
+def get_all_users() -> list[dict]:
+    return list(iter_all_users())
 
 
 def ban_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE users SET is_banned = 1 WHERE telegram_id = ?", (telegram_id,)
@@ -2568,7 +2993,7 @@ def ban_user(telegram_id: int):
 
 def unban_user(telegram_id: int):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE users SET is_banned = 0 WHERE telegram_id = ?", (telegram_id,)
@@ -2580,7 +3005,7 @@ def unban_user(telegram_id: int):
 
 def delete_user_keys(user_id: int) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute("DELETE FROM vpn_keys WHERE user_id = ?", (user_id,))
             conn.commit()
@@ -2596,7 +3021,7 @@ def delete_keys_by_ids(key_ids: list[int]) -> int:
 
     placeholders = ",".join("?" for _ in key_ids)
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 f"DELETE FROM vpn_keys WHERE key_id IN ({placeholders})",
@@ -2611,7 +3036,7 @@ def delete_keys_by_ids(key_ids: list[int]) -> int:
 
 def delete_user_everywhere(user_id: int) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
 
             cursor.execute(
@@ -2639,19 +3064,13 @@ def is_notification_sent(
     user_id: int, key_id: int | None, notification_type: str, hours_mark: int | None
 ) -> bool:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
-            if key_id is not None:
-                cursor.execute(
-                    "SELECT 1 FROM sent_notifications WHERE user_id = ? AND key_id = ? AND notification_type = ? AND hours_mark = ?",
-                    (user_id, key_id, notification_type, hours_mark),
-                )
-            else:
-                cursor.execute(
-                    "SELECT 1 FROM sent_notifications WHERE user_id = ? AND key_id IS NULL AND notification_type = ? AND hours_mark = ?",
-                    (user_id, notification_type, hours_mark),
-                )
-            return cursor.fetchone() is not None
+            cursor.execute(
+                _SQL_IS_NOTIFICATION_SENT,
+                (user_id, key_id, notification_type, hours_mark),
+            )
+            return bool(cursor.fetchone()[0])
     except Exception as e:
         logger.error(f"Error checking sent notification: {e}")
         return False
@@ -2661,10 +3080,10 @@ def mark_notification_sent(
     user_id: int, key_id: int | None, notification_type: str, hours_mark: int | None
 ):
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
-                "INSERT INTO sent_notifications (user_id, key_id, notification_type, hours_mark) VALUES (?, ?, ?, ?)",
+                _SQL_INSERT_SENT_NOTIFICATION,
                 (user_id, key_id, notification_type, hours_mark),
             )
             conn.commit()
@@ -2672,27 +3091,87 @@ def mark_notification_sent(
         logger.error(f"Error marking notification sent: {e}")
 
 
-def cleanup_notifications(days_to_keep: int = 30):
+def mark_notifications_sent(rows: list[tuple[int, int | None, str, int | None]]):
+    """
+    Batch form of mark_notification_sent: rows of
+    (user_id, key_id, notification_type, hours_mark). Callers should
+    accumulate rows (up to ~100) and flush them in one transaction.
+    """
+    if not rows:
+        return
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
-            cursor.execute("PRAGMA table_info(sent_notifications)")
-            columns = [row[1] for row in cursor.fetchall()]
+            cursor.executemany(_SQL_INSERT_SENT_NOTIFICATION, rows)
+            conn.commit()
+    except Exception as e:
+        logger.error(f"Error marking {len(rows)} notifications sent: {e}")
 
-            # Historical schema used "sent_at". Some old DBs may have "created_at".
-            date_column = None
-            if "sent_at" in columns:
-                date_column = "sent_at"
-            elif "created_at" in columns:
-                date_column = "created_at"
-            else:
-                # Keep compatibility with legacy DBs by adding a timestamp column once.
-                cursor.execute(
-                    "ALTER TABLE sent_notifications ADD COLUMN sent_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP"
+
+def get_sent_notifications_bulk(
+    candidates: list[tuple[int, int | None, str, int | None]],
+) -> set[tuple[int, int | None, str, int | None]]:
+    """
+    Return the subset of (user_id, key_id, notification_type, hours_mark)
+    candidates that were already sent.
+
+    All candidates are probed in one statement: SQLite's json_each expands the
+    bound JSON array and each row is an index lookup, so the whole batch costs a
+    single bind/step round-trip instead of one query per candidate.
+    """
+    if not candidates:
+        return set()
+    try:
+        with _get_ro_conn() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                """
+                SELECT DISTINCT
+                    json_extract(c.value, '$[0]'),
+                    json_extract(c.value, '$[1]'),
+                    json_extract(c.value, '$[2]'),
+                    json_extract(c.value, '$[3]')
+                FROM json_each(?) AS c
+                WHERE EXISTS (
+                    SELECT 1 FROM sent_notifications s
+                    WHERE s.user_id = json_extract(c.value, '$[0]')
+                      AND s.notification_type = json_extract(c.value, '$[2]')
+                      AND s.hours_mark IS json_extract(c.value, '$[3]')
+                      AND s.key_id IS json_extract(c.value, '$[1]')
                 )
-                conn.commit()
-                date_column = "sent_at"
+                """,
+                (json.dumps([list(c) for c in candidates]),),
+            )
+            return {tuple(row) for row in cursor.fetchall()}
+    except Exception as e:
+        logger.error(f"Error checking sent notifications in bulk: {e}")
+        return set()
+
+
+_sn_date_column: str | None = None
+
 
+def _sent_notifications_date_column(cursor: sqlite3.Cursor) -> str:
+    """
+    Timestamp column of sent_notifications ("sent_at", or "created_at" on some
+    old DBs). run_migration guarantees one exists, so the catalog is read once
+    and cached until reset_connections().
+    """
+    global _sn_date_column
+    if _sn_date_column is None:
+        columns = _table_columns(cursor, "sent_notifications")
+        if "sent_at" not in columns and "created_at" in columns:
+            _sn_date_column = "created_at"
+        else:
+            _sn_date_column = "sent_at"
+    return _sn_date_column
+
+
+def cleanup_notifications(days_to_keep: int = 30):
+    try:
+        with _write_lock, _get_rw_conn() as conn:
+            cursor = conn.cursor()
+            date_column = _sent_notifications_date_column(cursor)
             cursor.execute(
                 f"DELETE FROM sent_notifications WHERE {date_column} < datetime('now', ?)",
                 (f"-{days_to_keep} days",),
@@ -2717,7 +3196,7 @@ def set_pending_payment(user_id: int, is_pending: bool) -> bool:
     Returns True if successful, False otherwise.
     """
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             if is_pending:
                 cursor.execute(
@@ -2762,7 +3241,7 @@ def get_pending_payment_status(user_id: int) -> bool:
     Returns True if there's a pending payment, False otherwise.
     """
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT pending_payment FROM users WHERE telegram_id = ?", (user_id,)
@@ -2787,7 +3266,7 @@ def clear_all_pending_payments() -> int:
     Returns count of affected users.
     """
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "UPDATE users SET pending_payment = 0 WHERE pending_payment = 1"
@@ -2816,7 +3295,7 @@ ALL_PAYMENT_METHODS = ["yookassa", "stars", "p2p", "cryptobot"]
 def get_payment_rules_for_context(context_key: str) -> dict[str, bool] | None:
     """Return {method: bool} dict for the given context, or None if no rules defined."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT method, is_enabled FROM payment_method_rules WHERE context_key = ?",
@@ -2834,7 +3313,7 @@ def get_payment_rules_for_context(context_key: str) -> dict[str, bool] | None:
 def set_payment_rule(context_key: str, method: str, is_enabled: bool) -> None:
     """Insert or update a single payment method rule."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "INSERT OR REPLACE INTO payment_method_rules (context_key, method, is_enabled) VALUES (?, ?, ?)",
@@ -2848,7 +3327,7 @@ def set_payment_rule(context_key: str, method: str, is_enabled: bool) -> None:
 def delete_payment_rules_for_context(context_key: str) -> None:
     """Remove all rules for a context (resets to global defaults)."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "DELETE FROM payment_method_rules WHERE context_key = ?", (context_key,)
@@ -2861,7 +3340,7 @@ def delete_payment_rules_for_context(context_key: str) -> None:
 def get_all_payment_rules() -> dict[str, dict[str, bool]]:
     """Return all rules grouped by context_key: {context_key: {method: bool}}."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _get_ro_conn() as conn:
             cursor = conn.cursor()
             cursor.execute(
                 "SELECT context_key, method, is_enabled FROM payment_method_rules ORDER BY context_key, method"
@@ -2882,7 +3361,7 @@ def get_all_payment_rules() -> dict[str, dict[str, bool]]:
 
 def create_p2p_request(request_id: str, data: dict) -> None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             conn.execute(
                 """INSERT OR REPLACE INTO p2p_requests
                    (request_id, user_id, plan_id, months, price, action, key_id, host_name, customer_email, submitted, created_at)
@@ -2908,13 +3387,12 @@ def create_p2p_request(request_id: str, data: dict) -> None:
 
 def get_p2p_request(request_id: str) -> dict | None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            row = conn.execute(
+        with _get_ro_conn() as conn:
+            cursor = conn.execute(
                 "SELECT * FROM p2p_requests WHERE request_id = ?", (request_id,)
-            ).fetchone()
-            if row:
-                d = dict(row)
+            )
+            d = _fetch_dict(cursor)
+            if d:
                 d["submitted"] = bool(d["submitted"])
                 d["payment_method"] = "P2P"
                 return d
@@ -2927,14 +3405,13 @@ def get_p2p_request(request_id: str) -> dict | None:
 def get_active_p2p_request_for_user(user_id: int) -> dict | None:
     """Return a submitted-but-not-yet-resolved request for user, if any."""
     try:
-        with sqlite3.connect(DB_FILE) as conn:
-            conn.row_factory = sqlite3.Row
-            row = conn.execute(
+        with _get_ro_conn() as conn:
+            cursor = conn.execute(
                 "SELECT * FROM p2p_requests WHERE user_id = ? AND submitted = 1 ORDER BY created_at DESC LIMIT 1",
                 (user_id,),
-            ).fetchone()
-            if row:
-                d = dict(row)
+            )
+            d = _fetch_dict(cursor)
+            if d:
                 d["submitted"] = bool(d["submitted"])
                 d["payment_method"] = "P2P"
                 return d
@@ -2946,7 +3423,7 @@ def get_active_p2p_request_for_user(user_id: int) -> dict | None:
 
 def mark_p2p_request_submitted(request_id: str) -> None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             conn.execute(
                 "UPDATE p2p_requests SET submitted = 1 WHERE request_id = ?",
                 (request_id,),
@@ -2958,7 +3435,7 @@ def mark_p2p_request_submitted(request_id: str) -> None:
 
 def delete_p2p_request(request_id: str) -> None:
     try:
-        with sqlite3.connect(DB_FILE) as conn:
+        with _write_lock, _get_rw_conn() as conn:
             conn.execute("DELETE FROM p2p_requests WHERE request_id = ?", (request_id,))
             conn.commit()
     except sqlite3.Error as e:
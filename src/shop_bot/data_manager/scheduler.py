@@ -1,8 +1,10 @@
 import asyncio
+import functools
 import logging
-import math
 import time
 
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from shop_bot.utils import time_utils
 
@@ -19,13 +21,75 @@ from shop_bot.bot import keyboards
 CHECK_INTERVAL_SECONDS = 60
 PAID_NOTIFY_HOURS = {24, 1, 0}
 TRIAL_NOTIFY_HOURS = {1, 0}
+# Bounds of the notify windows: a key is due for a mark m while
+# m - 1 < hours_left <= m, so anything outside (min - 1, max] matches none.
+_PAID_NOTIFY_RANGE = (min(PAID_NOTIFY_HOURS) - 1, max(PAID_NOTIFY_HOURS))
+_TRIAL_NOTIFY_RANGE = (min(TRIAL_NOTIFY_HOURS) - 1, max(TRIAL_NOTIFY_HOURS))
+_ONE_HOUR = timedelta(hours=1)
+NOTIFICATION_FLUSH_SIZE = 100
+NOTIFICATION_SEND_CONCURRENCY = 20
+PANEL_SYNC_CONCURRENCY = 4
 
 _DEFAULT_PROVISION_TIMEOUT_SECONDS = 45
 
+# Database calls get their own small pool. Each worker keeps its cached
+# read connection for the life of the process, and panel I/O on the default
+# executor cannot starve DB work (or spawn extra connections).
+_DB_EXECUTOR = ThreadPoolExecutor(max_workers=4, thread_name_prefix="scheduler-db")
 
 logger = logging.getLogger(__name__)
 
 
+async def _run_db(func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(
+        _DB_EXECUTOR, functools.partial(func, *args, **kwargs)
+    )
+
+
+# user_id -> (frozenset of (key_id, expiry_date) pairs, earliest expiry) for
+# global subscriptions, rebuilt by each expiry check.
+_global_expiry_cache: dict[int, tuple[frozenset, datetime | None]] = {}
+
+
+# Hosts without any bot keys are only logged in to for the orphan-client audit,
+# which runs at most once per interval instead of every panel sync.
+ORPHAN_AUDIT_INTERVAL_SECONDS = 3600
+_last_orphan_audit_time: float | None = None
+
+
+# Global ("ALL" host) plans change only from the admin panel, so their ids are
+# reused across scheduler cycles; the plan routes drop the cache explicitly.
+GLOBAL_PLAN_IDS_TTL_SECONDS = 600
+_global_plan_ids_cache: tuple[float, set[int]] | None = None
+
+
+def invalidate_global_plan_ids_cache() -> None:
+    global _global_plan_ids_cache
+    _global_plan_ids_cache = None
+
+
+async def _get_global_plan_ids() -> set[int]:
+    """
+    Ids of the global plans. An empty result is not cached: a failed DB read
+    also comes back empty and must not hide global plans for the whole TTL.
+    """
+    global _global_plan_ids_cache
+    cached = _global_plan_ids_cache
+    if cached and time.monotonic() - cached[0] < GLOBAL_PLAN_IDS_TTL_SECONDS:
+        return cached[1]
+
+    global_plan_ids: set[int] = set()
+    for p in await _run_db(database.get_plans_for_host, "ALL"):
+        try:
+            global_plan_ids.add(int(p.get("plan_id")))
+        except (ValueError, TypeError):
+            continue
+    if global_plan_ids:
+        _global_plan_ids_cache = (time.monotonic(), global_plan_ids)
+    return global_plan_ids
+
+
 def _bool_setting(key: str, default: bool = False) -> bool:
     raw = database.get_setting(key)
     if raw is None:
@@ -42,6 +106,7 @@ def _provision_timeout_seconds() -> int:
     return max(10, min(timeout, 180))
 
 
+@functools.lru_cache(maxsize=256)
 def format_time_left(hours: int) -> str:
     if hours >= 24:
         days = hours // 24
@@ -60,6 +125,60 @@ def format_time_left(hours: int) -> str:
             return f"{hours} часов"
 
 
+# Expiry notification texts; only the time/date/host-count fields vary per send.
+_MSG_KEY_EXPIRING = (
+    "⚠️ **Внимание!** ⚠️\n\n"
+    "Срок действия вашей подписки истекает через **{time_text}**.\n"
+    "Дата окончания: **{expiry_str}**\n\n"
+    "Продлите подписку, чтобы не остаться без доступа к VPN!"
+)
+_MSG_KEY_EXPIRED = (
+    "❌ **Срок действия вашей подписки истек!**\n\n"
+    "Ваш доступ к VPN на сервере временно ограничен.\n"
+    "Дата окончания: **{expiry_str}**\n\n"
+    "Продлите подписку прямо сейчас, чтобы восстановить соединение!"
+)
+_MSG_KEY_FOLLOW_UP = (
+    "👋 **Мы скучаем!**\n\n"
+    "Заметили, что вы не продлили подписку, которая истекла вчера ({expiry_str}).\n\n"
+    "Если у вас возникли трудности с оплатой или настройкой — напишите в нашу поддержку, мы обязательно поможем!"
+)
+_MSG_GLOBAL_EXPIRING = (
+    "⚠️ **Внимание!** ⚠️\n\n"
+    "Срок действия вашей **глобальной подписки** (на {hosts_count} сервер(ов)) истекает через **{time_text}**.\n"
+    "Дата окончания: **{expiry_str}**\n\n"
+    "Продлите подписку, чтобы не остаться без доступа к VPN!"
+)
+_MSG_GLOBAL_EXPIRED = (
+    "❌ **Ваша глобальная подписка истекла!**\n\n"
+    "Ваш доступ ко всем серверам ({hosts_count} шт.) ограничен.\n"
+    "Дата окончания: **{expiry_str}**\n\n"
+    "Продлите подписку, чтобы вернуть доступ сразу ко всем серверам!"
+)
+_MSG_GLOBAL_FOLLOW_UP = (
+    "👋 **Мы скучаем!**\n\n"
+    "Заметили, что вы не продлили вашу глобальную подписку, которая истекла вчера ({expiry_str}).\n\n"
+    "Если у вас возникли трудности — наша поддержка всегда на связи!"
+)
+_MSG_PROXY_EXPIRING = (
+    "⚠️ **Внимание!** ⚠️\n\n"
+    "Срок действия вашего **Telegram-прокси** истекает через **{time_text}**.\n"
+    "Дата окончания: **{expiry_str}**\n\n"
+    "Продлите прокси, чтобы не остаться без доступа к Telegram!"
+)
+_MSG_PROXY_EXPIRED = (
+    "❌ **Срок действия вашего Telegram-прокси истёк!**\n\n"
+    "Прокси временно отключён.\n"
+    "Дата окончания: **{expiry_str}**\n\n"
+    "Продлите прокси, чтобы восстановить доступ!"
+)
+_MSG_PROXY_FOLLOW_UP = (
+    "👋 **Мы скучаем!**\n\n"
+    "Заметили, что вы не продлили прокси, который истёк вчера ({expiry_str}).\n\n"
+    "Если у вас возникли трудности — напишите в нашу поддержку, мы поможем!"
+)
+
+
 async def send_subscription_notification(
     bot: Bot,
     user_id: int,
@@ -73,30 +192,18 @@ async def send_subscription_notification(
 
         if time_left_hours > 0:
             time_text = format_time_left(time_left_hours)
-            message = (
-                f"⚠️ **Внимание!** ⚠️\n\n"
-                f"Срок действия вашей подписки истекает через **{time_text}**.\n"
-                f"Дата окончания: **{expiry_str}**\n\n"
-                f"Продлите подписку, чтобы не остаться без доступа к VPN!"
+            message = _MSG_KEY_EXPIRING.format(
+                time_text=time_text, expiry_str=expiry_str
             )
             btn_text = "➕ Продлить ключ"
             # If trial, direct to new purchase flow as requested
             callback_data = "buy_new_key" if is_trial else f"extend_key_{key_id}"
         elif time_left_hours == 0:
-            message = (
-                f"❌ **Срок действия вашей подписки истек!**\n\n"
-                f"Ваш доступ к VPN на сервере временно ограничен.\n"
-                f"Дата окончания: **{expiry_str}**\n\n"
-                "Продлите подписку прямо сейчас, чтобы восстановить соединение!"
-            )
+            message = _MSG_KEY_EXPIRED.format(expiry_str=expiry_str)
             btn_text = "➕ Восстановить доступ"
             callback_data = "buy_new_key" if is_trial else f"extend_key_{key_id}"
         else:  # -24 follow-up
-            message = (
-                f"👋 **Мы скучаем!**\n\n"
-                f"Заметили, что вы не продлили подписку, которая истекла вчера ({expiry_str}).\n\n"
-                f"Если у вас возникли трудности с оплатой или настройкой — напишите в нашу поддержку, мы обязательно поможем!"
-            )
+            message = _MSG_KEY_FOLLOW_UP.format(expiry_str=expiry_str)
             btn_text = "➕ Купить подписку"
             callback_data = "buy_new_key"
 
@@ -131,27 +238,17 @@ async def send_global_subscription_notification(
 
         if time_left_hours > 0:
             time_text = format_time_left(time_left_hours)
-            message = (
-                f"⚠️ **Внимание!** ⚠️\n\n"
-                f"Срок действия вашей **глобальной подписки** (на {hosts_count} сервер(ов)) истекает через **{time_text}**.\n"
-                f"Дата окончания: **{expiry_str}**\n\n"
-                f"Продлите подписку, чтобы не остаться без доступа к VPN!"
+            message = _MSG_GLOBAL_EXPIRING.format(
+                hosts_count=hosts_count, time_text=time_text, expiry_str=expiry_str
             )
             btn_text = "➕ Продлить подписку"
         elif time_left_hours == 0:
-            message = (
-                f"❌ **Ваша глобальная подписка истекла!**\n\n"
-                f"Ваш доступ ко всем серверам ({hosts_count} шт.) ограничен.\n"
-                f"Дата окончания: **{expiry_str}**\n\n"
-                "Продлите подписку, чтобы вернуть доступ сразу ко всем серверам!"
+            message = _MSG_GLOBAL_EXPIRED.format(
+                hosts_count=hosts_count, expiry_str=expiry_str
             )
             btn_text = "➕ Восстановить доступ"
         else:  # -24 follow-up
-            message = (
-                f"👋 **Мы скучаем!**\n\n"
-                f"Заметили, что вы не продлили вашу глобальную подписку, которая истекла вчера ({expiry_str}).\n\n"
-                f"Если у вас возникли трудности — наша поддержка всегда на связи!"
-            )
+            message = _MSG_GLOBAL_FOLLOW_UP.format(expiry_str=expiry_str)
             btn_text = "💳 Купить подписку"
 
         builder = InlineKeyboardBuilder()
@@ -183,29 +280,17 @@ async def send_proxy_expiry_notification(
 
         if time_left_hours > 0:
             time_text = format_time_left(time_left_hours)
-            message = (
-                f"⚠️ **Внимание!** ⚠️\n\n"
-                f"Срок действия вашего **Telegram-прокси** истекает через **{time_text}**.\n"
-                f"Дата окончания: **{expiry_str}**\n\n"
-                f"Продлите прокси, чтобы не остаться без доступа к Telegram!"
+            message = _MSG_PROXY_EXPIRING.format(
+                time_text=time_text, expiry_str=expiry_str
             )
             btn_text = "➕ Продлить прокси"
             callback_data = f"extend_key_{key_id}"
         elif time_left_hours == 0:
-            message = (
-                f"❌ **Срок действия вашего Telegram-прокси истёк!**\n\n"
-                f"Прокси временно отключён.\n"
-                f"Дата окончания: **{expiry_str}**\n\n"
-                "Продлите прокси, чтобы восстановить доступ!"
-            )
+            message = _MSG_PROXY_EXPIRED.format(expiry_str=expiry_str)
             btn_text = "➕ Активировать прокси"
             callback_data = f"extend_key_{key_id}"
         else:  # -24 follow-up
-            message = (
-                f"👋 **Мы скучаем!**\n\n"
-                f"Заметили, что вы не продлили прокси, который истёк вчера ({expiry_str}).\n\n"
-                f"Если у вас возникли трудности — напишите в нашу поддержку, мы поможем!"
-            )
+            message = _MSG_PROXY_FOLLOW_UP.format(expiry_str=expiry_str)
             btn_text = "➕ Купить прокси"
             callback_data = "buy_proxy"
 
@@ -229,6 +314,28 @@ async def send_proxy_expiry_notification(
         return False
 
 
+def _due_hours_mark(
+    expiry_date: datetime, is_trial: bool, now: datetime | None = None
+) -> int | None:
+    """The notify mark whose one-hour window the key is in right now, if any."""
+    current_time = now or time_utils.get_msk_now()
+    time_left = expiry_date - current_time
+    # Ceiling division on timedeltas stays exact (microseconds included)
+    total_hours_left = -(-time_left // _ONE_HOUR)
+
+    if is_trial:
+        marks, (low, high) = TRIAL_NOTIFY_HOURS, _TRIAL_NOTIFY_RANGE
+    else:
+        marks, (low, high) = PAID_NOTIFY_HOURS, _PAID_NOTIFY_RANGE
+    # Most keys are days away from expiry; skip the mark scan for them.
+    if not low < total_hours_left <= high:
+        return None
+    for hours_mark in marks:
+        if hours_mark - 1 < total_hours_left <= hours_mark:
+            return hours_mark
+    return None
+
+
 async def _process_notification(
     bot: Bot,
     user_id: int,
@@ -237,152 +344,222 @@ async def _process_notification(
     is_trial: bool,
     hosts_count: int = 1,
     service_type: str = "xui",
+    sent_rows: list[tuple] | None = None,
+    sent_set: set[tuple] | None = None,
+    now: datetime | None = None,
 ) -> bool:
-    current_time = time_utils.get_msk_now()
-    time_left = expiry_date - current_time
-    total_hours_left = math.ceil(time_left.total_seconds() / 3600)
+    """
+    When sent_rows is given, successful sends are appended to it as
+    sent_notifications rows for the caller to flush in one batch. When
+    sent_set is given it replaces the per-call is_notification_sent query;
+    it must have been prefetched for the same `now`.
+    """
+    hours_mark = _due_hours_mark(expiry_date, is_trial, now)
+    if hours_mark is None:
+        return False
 
-    marks = TRIAL_NOTIFY_HOURS if is_trial else PAID_NOTIFY_HOURS
-    # Check regular expiry
-    for hours_mark in marks:
-        if hours_mark - 1 < total_hours_left <= hours_mark:
-            notification_type = "global_expiry" if key_id is None else "expiry"
-
-            already_sent = await asyncio.to_thread(
-                database.is_notification_sent,
-                user_id,
-                key_id,
-                notification_type,
-                hours_mark,
-            )
-            if already_sent:
-                return True
+    notification_type = "global_expiry" if key_id is None else "expiry"
+    row = (user_id, key_id, notification_type, hours_mark)
+    if sent_set is not None:
+        already_sent = row in sent_set
+    else:
+        already_sent = await _run_db(database.is_notification_sent, *row)
+    if already_sent:
+        return True
 
-            if key_id is None:  # Global
-                sent_ok = await send_global_subscription_notification(
-                    bot, user_id, hours_mark, expiry_date, hosts_count
-                )
-            elif service_type == "mtg":
-                sent_ok = await send_proxy_expiry_notification(
-                    bot, user_id, key_id, hours_mark, expiry_date
-                )
-            else:
-                sent_ok = await send_subscription_notification(
-                    bot, user_id, key_id, hours_mark, expiry_date, is_trial
-                )
+    if key_id is None:  # Global
+        sent_ok = await send_global_subscription_notification(
+            bot, user_id, hours_mark, expiry_date, hosts_count
+        )
+    elif service_type == "mtg":
+        sent_ok = await send_proxy_expiry_notification(
+            bot, user_id, key_id, hours_mark, expiry_date
+        )
+    else:
+        sent_ok = await send_subscription_notification(
+            bot, user_id, key_id, hours_mark, expiry_date, is_trial
+        )
 
-            if sent_ok:
-                await asyncio.to_thread(
-                    database.mark_notification_sent,
-                    user_id,
-                    key_id,
-                    notification_type,
-                    hours_mark,
-                )
-                return True
+    if sent_ok:
+        if sent_set is not None:
+            sent_set.add(row)
+        if sent_rows is not None:
+            sent_rows.append(row)
+        else:
+            await _run_db(database.mark_notification_sent, *row)
+        return True
 
-            logger.warning(
-                "Scheduler: Notification send failed for user=%s key_id=%s type=%s mark=%s; not marking as sent.",
-                user_id,
-                key_id,
-                notification_type,
-                hours_mark,
-            )
-            return False
+    logger.warning(
+        "Scheduler: Notification send failed for user=%s key_id=%s type=%s mark=%s; not marking as sent.",
+        user_id,
+        key_id,
+        notification_type,
+        hours_mark,
+    )
     return False
 
 
+async def _flush_sent_notifications(sent_rows: list[tuple]) -> None:
+    # Detach the batch before awaiting so concurrent senders can keep appending.
+    if sent_rows:
+        rows = sent_rows[:]
+        sent_rows.clear()
+        await _run_db(database.mark_notifications_sent, rows)
+
+
 async def check_expiring_subscriptions(bot: Bot):
     logger.info("Scheduler: Checking for expiring subscriptions...")
-    all_keys = await asyncio.to_thread(database.get_all_keys)
+    sent_rows: list[tuple] = []
+    try:
+        await _check_expiring_subscriptions(bot, sent_rows)
+    finally:
+        await _flush_sent_notifications(sent_rows)
+
+
+async def _check_expiring_subscriptions(bot: Bot, sent_rows: list[tuple]):
+    all_keys = await _run_db(database.get_keys_for_expiry_check)
 
     # Determine global plan ids (host_name == 'ALL')
-    global_plan_ids: set[int] = set()
     try:
-        global_plans = await asyncio.to_thread(database.get_plans_for_host, "ALL")
-        for p in global_plans:
-            try:
-                global_plan_ids.add(int(p.get("plan_id")))
-            except Exception:
-                continue
+        global_plan_ids = await _get_global_plan_ids()
     except Exception:
         global_plan_ids = set()
 
     # Build per-user buckets for global subscription keys
-    global_keys_by_user: dict[int, list[dict]] = {}
+    global_keys_by_user: defaultdict[int, list[dict]] = defaultdict(list)
     remaining_keys: list[dict] = []
 
     for key in all_keys:
         try:
             plan_id = key.get("plan_id", 0)
-            if (
-                plan_id is not None
-                and int(plan_id) in global_plan_ids
-                and int(plan_id) > 0
-            ):
-                global_keys_by_user.setdefault(int(key["user_id"]), []).append(key)
+            if plan_id is not None:
+                plan_id = int(plan_id)
+            if plan_id is not None and plan_id in global_plan_ids and plan_id > 0:
+                global_keys_by_user[int(key["user_id"])].append(key)
             else:
                 remaining_keys.append(key)
         except Exception:
             remaining_keys.append(key)
 
-    # 1. Process GLOBAL notifications
-    processed_global_users: set[int] = set()
+    # Earliest expiry across each user's global keys, reused from the previous
+    # cycle while the user's (key_id, expiry_date) pairs are unchanged
+    global _global_expiry_cache
+    global_expiry_cache: dict[int, tuple[frozenset, datetime | None]] = {}
+    global_expiry_by_user: dict[int, tuple[datetime, int]] = {}
     for user_id, keys in global_keys_by_user.items():
         try:
-            expiry_dates: list[datetime] = []
-            for k in keys:
-                if not k.get("expiry_date"):
-                    continue
-                dt = time_utils.parse_iso_to_msk(k["expiry_date"])
-                if dt:
-                    expiry_dates.append(dt)
-
-            if not expiry_dates:
-                continue
-
-            earliest_expiry = min(expiry_dates)
-            global_window_processed = await _process_notification(
-                bot,
-                user_id,
-                None,
-                earliest_expiry,
-                is_trial=False,
-                hosts_count=len(keys),
-            )
-            if global_window_processed:
-                processed_global_users.add(user_id)
-
+            signature = frozenset((k.get("key_id"), k.get("expiry_date")) for k in keys)
+            cached = _global_expiry_cache.get(user_id)
+            if cached and cached[0] == signature:
+                earliest_expiry = cached[1]
+            else:
+                expiry_dates: list[datetime] = []
+                for k in keys:
+                    if not k.get("expiry_date"):
+                        continue
+                    dt = time_utils.parse_iso_to_msk(k["expiry_date"])
+                    if dt:
+                        expiry_dates.append(dt)
+                earliest_expiry = min(expiry_dates) if expiry_dates else None
+            global_expiry_cache[user_id] = (signature, earliest_expiry)
+
+            if earliest_expiry:
+                global_expiry_by_user[user_id] = (earliest_expiry, len(keys))
         except Exception as e:
             logger.error(f"Error processing GLOBAL expiry for user {user_id}: {e}")
+    # Only this cycle's users are kept, so the cache never outgrows the user base
+    _global_expiry_cache = global_expiry_cache
 
-    # 2. Process Regular & Trial keys (SKIP users already notified globally)
+    # Parse regular & trial keys once, then fetch every "already sent" marker
+    # the pass can ask about in a single query.
+    now = time_utils.get_msk_now()
+    regular_items: list[tuple[dict, datetime, bool]] = []
     for key in remaining_keys:
         try:
             if not key.get("expiry_date"):
                 continue
-
             expiry_date = time_utils.parse_iso_to_msk(key["expiry_date"])
             if not expiry_date:
                 continue
+            is_trial = int(key.get("plan_id", 0) or 0) == 0
+            regular_items.append((key, expiry_date, is_trial))
+        except Exception as e:
+            logger.error(f"Error processing expiry for key {key.get('key_id')}: {e}")
 
-            user_id = key["user_id"]
+    candidates: list[tuple] = []
+    for user_id, (earliest_expiry, _) in global_expiry_by_user.items():
+        hours_mark = _due_hours_mark(earliest_expiry, False, now)
+        if hours_mark is not None:
+            candidates.append((user_id, None, "global_expiry", hours_mark))
+    for key, expiry_date, is_trial in regular_items:
+        hours_mark = _due_hours_mark(expiry_date, is_trial, now)
+        if hours_mark is not None:
+            candidates.append((key["user_id"], key["key_id"], "expiry", hours_mark))
+    sent_set = await _run_db(database.get_sent_notifications_bulk, candidates)
+
+    # Sends are Telegram round-trips, so each stage runs them concurrently;
+    # the semaphore keeps the burst under the bot API rate limit.
+    semaphore = asyncio.Semaphore(NOTIFICATION_SEND_CONCURRENCY)
 
-            # Skip users who were already notified via global subscription
-            if user_id in processed_global_users:
-                continue
+    # 1. Process GLOBAL notifications
+    processed_global_users: set[int] = set()
 
-            key_id = key["key_id"]
-            plan_id = int(key.get("plan_id", 0) or 0)
-            is_trial = plan_id == 0
-            service_type = key.get("service_type", "xui")
+    async def _notify_global(user_id: int, earliest_expiry: datetime, hosts_count: int):
+        async with semaphore:
+            try:
+                global_window_processed = await _process_notification(
+                    bot,
+                    user_id,
+                    None,
+                    earliest_expiry,
+                    is_trial=False,
+                    hosts_count=hosts_count,
+                    sent_rows=sent_rows,
+                    sent_set=sent_set,
+                    now=now,
+                )
+                if global_window_processed:
+                    processed_global_users.add(user_id)
+            except Exception as e:
+                logger.error(f"Error processing GLOBAL expiry for user {user_id}: {e}")
+
+    await asyncio.gather(
+        *(
+            _notify_global(user_id, earliest_expiry, hosts_count)
+            for user_id, (earliest_expiry, hosts_count) in global_expiry_by_user.items()
+        )
+    )
 
-            await _process_notification(
-                bot, user_id, key_id, expiry_date, is_trial, service_type=service_type
-            )
+    # 2. Process Regular & Trial keys (SKIP users already notified globally)
+    async def _notify_key(key: dict, expiry_date: datetime, is_trial: bool):
+        async with semaphore:
+            try:
+                await _process_notification(
+                    bot,
+                    key["user_id"],
+                    key["key_id"],
+                    expiry_date,
+                    is_trial,
+                    service_type=key.get("service_type", "xui"),
+                    sent_rows=sent_rows,
+                    sent_set=sent_set,
+                    now=now,
+                )
+                if len(sent_rows) >= NOTIFICATION_FLUSH_SIZE:
+                    await _flush_sent_notifications(sent_rows)
+            except Exception as e:
+                logger.error(
+                    f"Error processing expiry for key {key.get('key_id')}: {e}"
+                )
 
-        except Exception as e:
-            logger.error(f"Error processing expiry for key {key.get('key_id')}: {e}")
+    await asyncio.gather(
+        *(
+            _notify_key(key, expiry_date, is_trial)
+            for key, expiry_date, is_trial in regular_items
+            # Skip users who were already notified via global subscription
+            if key["user_id"] not in processed_global_users
+        )
+    )
 
 
 async def enforce_clients_state_from_db() -> None:
@@ -391,7 +568,7 @@ async def enforce_clients_state_from_db() -> None:
     on all enabled hosts every scheduler cycle.
     """
     logger.info("Scheduler: Enforcing client states from DB...")
-    all_hosts = await asyncio.to_thread(database.get_all_hosts, True)
+    all_hosts = await _run_db(database.get_all_hosts, True)
     if not all_hosts:
         logger.info("Scheduler: No enabled hosts configured. Enforce skipped.")
         return
@@ -410,7 +587,7 @@ async def enforce_clients_state_from_db() -> None:
         if not host_name:
             continue
 
-        keys_in_db = await asyncio.to_thread(database.get_keys_for_host, host_name)
+        keys_in_db = await _run_db(database.get_key_expiries_for_host, host_name)
         desired_by_email: dict[str, dict] = {}
         for db_key in keys_in_db:
             key_email = db_key.get("key_email")
@@ -458,32 +635,24 @@ async def enforce_clients_state_from_db() -> None:
     )
 
 
-async def sync_keys_with_panels():
-    logger.info("Scheduler: Starting sync with XUI panels...")
-    total_affected_records = 0
-    failed_hosts = []  # Collect failed hosts for summary log
-
-    all_hosts = await asyncio.to_thread(database.get_all_hosts, True)
-    if not all_hosts:
-        logger.info("Scheduler: No hosts configured in the database. Sync skipped.")
-        return
-
-    for host in all_hosts:
+async def _sync_host_with_panel(
+    host: dict, keys_in_db: list[dict], semaphore: asyncio.Semaphore
+) -> tuple[int, bool]:
+    """
+    Reconcile one host's keys with its panel.
+    Returns (records affected, whether the host was unreachable).
+    """
+    async with semaphore:
+        affected_records = 0
         host_name = host["host_name"]
-
         try:
-            api, inbound = xui_api.login_to_host(
-                host_url=host["host_url"],
-                username=host["host_username"],
-                password=host["host_pass"],
-                inbound_id=host["host_inbound_id"],
-            )
+            api, inbound = await xui_api.login_to_host_async(host)
 
             if not api or not inbound:
-                failed_hosts.append(host_name)
-                continue
+                return 0, True
 
-            full_inbound_details = api.inbound.get_by_id(inbound.id)
+            # login_to_host already returns the freshly fetched inbound
+            full_inbound_details = inbound
             if not full_inbound_details or not getattr(
                 full_inbound_details, "settings", None
             ):
@@ -491,8 +660,7 @@ async def sync_keys_with_panels():
                     f"Scheduler: Failed to load full inbound details for host '{host_name}' "
                     f"(inbound_id={host.get('host_inbound_id')})."
                 )
-                failed_hosts.append(host_name)
-                continue
+                return 0, True
 
             clients_on_server = {
                 client.email: client
@@ -503,38 +671,38 @@ async def sync_keys_with_panels():
                 f"Scheduler: Found {len(clients_on_server)} clients on the '{host_name}' panel."
             )
 
-            keys_in_db = await asyncio.to_thread(database.get_keys_for_host, host_name)
+            missing_rows = []
+            key_updates = []
+            uuid_updates = []
+            # One bookkeeping timestamp for every key marked missing on this host
+            missing_since = time_utils.get_msk_now().isoformat()
+
+            # The remark depends only on the host: country flag + cleaned name
+            server_remark = xui_api.build_server_remark(host_name)
+
+            # Loop-invariant lookups, bound once per host
+            get_connection_string = xui_api.get_connection_string
+            from_timestamp_ms = time_utils.from_timestamp_ms
+            pop_server_client = clients_on_server.pop
+            host_url = host["host_url"]
 
             for db_key in keys_in_db:
                 key_email = db_key["key_email"]
-                expiry_date = time_utils.parse_iso_to_msk(db_key["expiry_date"])
-                if not expiry_date:
+                local_expiry_ms = db_key["expiry_ms"]
+                if local_expiry_ms is None:
                     logger.error(
                         f"Scheduler: Invalid expiry date for key '{key_email}': {db_key.get('expiry_date')}"
                     )
                     continue
 
-                server_client = clients_on_server.pop(key_email, None)
+                server_client = pop_server_client(key_email, None)
 
                 if server_client:
-                    # Determine country flag based on server name
-                    country_flag = xui_api.get_country_flag_by_host(host_name)
-                    # Clean server name
-                    clean_server_name = (
-                        host_name.replace(" ", "")
-                        .encode("ascii", "ignore")
-                        .decode("ascii")
-                    )
-                    clean_server_name = "".join(
-                        c for c in clean_server_name if c.isalnum() or c == "_"
-                    ).lstrip("_")
-                    server_remark = f"{country_flag}{clean_server_name}"
-
                     # Generate fresh connection string
-                    new_connection_string = xui_api.get_connection_string(
+                    new_connection_string = get_connection_string(
                         full_inbound_details,
                         server_client.id,
-                        host["host_url"],
+                        host_url,
                         remark=server_remark,
                     )
 
@@ -542,8 +710,6 @@ async def sync_keys_with_panels():
                     server_expiry_ms = int(
                         getattr(server_client, "expiry_time", 0) or 0
                     )
-                    local_expiry_dt = expiry_date
-                    local_expiry_ms = int(local_expiry_dt.timestamp() * 1000)
 
                     # Update if expiry changed OR connection string needs update (e.g. flag changed)
                     current_db_string = db_key.get("connection_string")
@@ -561,12 +727,10 @@ async def sync_keys_with_panels():
                             new_connection_string
                             and new_connection_string != current_db_string
                         ):
-                            await asyncio.to_thread(
-                                database.update_key_connection_string,
-                                db_key["key_id"],
-                                new_connection_string,
+                            key_updates.append(
+                                (db_key["key_id"], None, new_connection_string)
                             )
-                            total_affected_records += 1
+                            affected_records += 1
                         continue
 
                     if (abs(server_expiry_ms - local_expiry_ms) > 1000) or (
@@ -575,38 +739,36 @@ async def sync_keys_with_panels():
                     ):
                         # Use update_key_info to update both expiry and string if needed
                         # Convert server expiry to datetime
-                        new_expiry_date_dt = time_utils.from_timestamp_ms(
-                            server_expiry_ms
-                        )
-                        await asyncio.to_thread(
-                            database.update_key_info,
-                            db_key["key_id"],
-                            new_expiry_date_dt,
-                            new_connection_string,
+                        new_expiry_date_dt = from_timestamp_ms(server_expiry_ms)
+                        key_updates.append(
+                            (
+                                db_key["key_id"],
+                                new_expiry_date_dt,
+                                new_connection_string,
+                            )
                         )
 
                         # Also sync UUID if changed (rare but possible)
                         if db_key["xui_client_uuid"] != server_client.id:
-                            await asyncio.to_thread(
-                                database.update_key_status_from_server,
-                                key_email,
-                                server_client,
+                            uuid_updates.append(
+                                (server_client.id, new_expiry_date_dt, key_email)
                             )
 
-                        total_affected_records += 1
+                        affected_records += 1
                         logger.info(
                             f"Scheduler: Synced key '{key_email}' for host '{host_name}'."
                         )
                 else:
                     # Soft-delete: mark missing, recheck next cycle before removal
-                    now_ts = time_utils.get_msk_now().isoformat()
-                    await asyncio.to_thread(
-                        database.mark_key_missing, key_email, now_ts, host_name
-                    )
+                    missing_rows.append((key_email, missing_since, host_name))
                     logger.warning(
                         f"Scheduler: Key '{key_email}' for host '{host_name}' not found on server. Marked missing for recheck."
                     )
-                    total_affected_records += 1
+                    affected_records += 1
+
+            await _run_db(
+                database.apply_key_sync_changes, key_updates, uuid_updates, missing_rows
+            )
 
             if clients_on_server:
                 for orphan_email in clients_on_server.keys():
@@ -619,6 +781,57 @@ async def sync_keys_with_panels():
                 f"Scheduler: An unexpected error occurred while processing host '{host_name}': {e}",
                 exc_info=True,
             )
+        return affected_records, False
+
+
+async def sync_keys_with_panels():
+    logger.info("Scheduler: Starting sync with XUI panels...")
+
+    all_hosts = await _run_db(database.get_all_hosts, True)
+    if not all_hosts:
+        logger.info("Scheduler: No hosts configured in the database. Sync skipped.")
+        return
+
+    keys_by_host = await _run_db(database.get_keys_grouped_by_host)
+
+    global _last_orphan_audit_time
+    now = time.monotonic()
+    if (
+        _last_orphan_audit_time is None
+        or now - _last_orphan_audit_time >= ORPHAN_AUDIT_INTERVAL_SECONDS
+    ):
+        _last_orphan_audit_time = now
+    else:
+        all_hosts = [h for h in all_hosts if keys_by_host.get(h["host_name"])]
+        if not all_hosts:
+            logger.info("Scheduler: No hosts with keys to sync this cycle.")
+            return
+
+    # Panels are independent, so hosts are synced concurrently; the semaphore
+    # caps how many panel sessions are open at once.
+    semaphore = asyncio.Semaphore(PANEL_SYNC_CONCURRENCY)
+    results = await asyncio.gather(
+        *(
+            _sync_host_with_panel(
+                host, keys_by_host.get(host["host_name"], []), semaphore
+            )
+            for host in all_hosts
+        ),
+        return_exceptions=True,
+    )
+
+    total_affected_records = 0
+    failed_hosts = []  # Collect failed hosts for summary log
+    for host, result in zip(all_hosts, results):
+        if isinstance(result, BaseException):
+            logger.error(
+                f"Scheduler: Sync task for host '{host.get('host_name')}' failed: {result}"
+            )
+            continue
+        affected, failed = result
+        total_affected_records += affected
+        if failed:
+            failed_hosts.append(host.get("host_name"))
 
     # Log summary of failed hosts (single line instead of multiple errors)
     if failed_hosts:
@@ -634,11 +847,24 @@ async def sync_keys_with_panels():
 async def cleanup_old_notifications():
     """Delete sent_notifications older than 30 days to keep DB size manageable."""
     try:
-        await asyncio.to_thread(database.cleanup_notifications, days_to_keep=30)
+        await _run_db(database.cleanup_notifications, days_to_keep=30)
     except Exception as e:
         logger.error(f"Scheduler: Failed to cleanup old notifications: {e}")
 
 
+def _keys_by_user() -> dict[int, list[dict]]:
+    """
+    Group every key by user_id, streaming rows instead of building the full
+    key list first. Runs on the DB executor, the thread that owns the iterator.
+    """
+    keys_by_user: defaultdict[int, list[dict]] = defaultdict(list)
+    for key in database.get_all_keys_iter():
+        user_id = key.get("user_id")
+        if user_id is not None:
+            keys_by_user[user_id].append(key)
+    return keys_by_user
+
+
 async def auto_provision_new_hosts_for_global_users():
     """
     Auto-provision keys on new hosts for all users with active global subscriptions.
@@ -652,7 +878,7 @@ async def auto_provision_new_hosts_for_global_users():
     )
 
     # Get all enabled hosts
-    all_hosts = await asyncio.to_thread(database.get_all_hosts, True)
+    all_hosts = await _run_db(database.get_all_hosts, True)
     if not all_hosts:
         logger.debug("Scheduler: No enabled hosts found.")
         return
@@ -667,14 +893,8 @@ async def auto_provision_new_hosts_for_global_users():
         return
 
     # Get global plan IDs
-    global_plan_ids = set()
     try:
-        global_plans = await asyncio.to_thread(database.get_plans_for_host, "ALL")
-        for p in global_plans:
-            try:
-                global_plan_ids.add(int(p.get("plan_id")))
-            except (ValueError, TypeError):
-                continue
+        global_plan_ids = await _get_global_plan_ids()
     except Exception as e:
         logger.error(f"Scheduler: Failed to get global plans: {e}")
         return
@@ -685,18 +905,8 @@ async def auto_provision_new_hosts_for_global_users():
         )
         return
 
-    # Get all keys and group by user
-    all_keys = await asyncio.to_thread(database.get_all_keys)
-
-    # Group keys by user_id
-    keys_by_user: dict[int, list] = {}
-    for key in all_keys:
-        user_id = key.get("user_id")
-        if user_id is None:
-            continue
-        if user_id not in keys_by_user:
-            keys_by_user[user_id] = []
-        keys_by_user[user_id].append(key)
+    # Get all keys grouped by user
+    keys_by_user = await _run_db(_keys_by_user)
 
     # Track statistics
     total_users_processed = 0
@@ -796,11 +1006,11 @@ async def auto_provision_new_hosts_for_global_users():
 
                     if res:
                         # Persist to database
-                        existing_key = await asyncio.to_thread(
+                        existing_key = await _run_db(
                             database.get_key_by_email, res["email"]
                         )
                         if existing_key:
-                            await asyncio.to_thread(
+                            await _run_db(
                                 database.update_key_by_email,
                                 key_email=res["email"],
                                 host_name=host_name,
@@ -810,7 +1020,7 @@ async def auto_provision_new_hosts_for_global_users():
                                 plan_id=first_global_plan_id,
                             )
                         else:
-                            await asyncio.to_thread(
+                            await _run_db(
                                 database.add_new_key,
                                 user_id=user_id,
                                 host_name=host_name,
@@ -909,14 +1119,14 @@ async def enforce_mtg_proxies_state() -> None:
     - Expired keys: stop proxy on panel (safety net; panel auto-stops too).
     - Active keys:  start proxy on panel (ensures post-renewal keys are running).
     """
-    mtg_keys = await asyncio.to_thread(database.get_keys_by_service_type, "mtg")
+    mtg_keys = await _run_db(database.get_keys_by_service_type, "mtg")
     if not mtg_keys:
         return
 
     now = time_utils.get_msk_now()
     enabled_hosts = {
         h["host_name"]
-        for h in await asyncio.to_thread(database.get_all_mtg_hosts, True)
+        for h in await _run_db(database.get_all_mtg_hosts, True)
     }
 
     for key in mtg_keys:
@@ -957,6 +1167,15 @@ async def periodic_subscription_check(bot_controller: BotController):
     xtls_sync_interval = 300  # 5 minutes
     last_xtls_sync_time = 0
 
+    # Truncate the SQLite WAL once an hour so it doesn't stay at its peak size
+    wal_checkpoint_interval = 3600
+    last_wal_checkpoint_time = time.time()
+
+    # Cycles are scheduled against a monotonic deadline so that slow cycles
+    # don't push every later one back by their duration.
+    loop = asyncio.get_running_loop()
+    next_tick = loop.time()
+
     while True:
         try:
             # Always enforce access state by DB even if panel_sync_enabled is disabled.
@@ -989,6 +1208,10 @@ async def periodic_subscription_check(bot_controller: BotController):
             elif current_time - last_xtls_sync_time >= xtls_sync_interval:
                 logger.debug("Scheduler: XTLS sync disabled (xtls_sync_enabled=false).")
 
+            if current_time - last_wal_checkpoint_time >= wal_checkpoint_interval:
+                await _run_db(database.checkpoint_wal)
+                last_wal_checkpoint_time = current_time
+
             if bot_controller.get_status().get("is_running"):
                 bot = bot_controller.get_bot_instance()
                 if bot:
@@ -1006,7 +1229,13 @@ async def periodic_subscription_check(bot_controller: BotController):
                 exc_info=True,
             )
 
-        logger.info(
-            f"Scheduler: Cycle finished. Next check in {CHECK_INTERVAL_SECONDS} seconds."
-        )
-        await asyncio.sleep(CHECK_INTERVAL_SECONDS)
+        next_tick += CHECK_INTERVAL_SECONDS
+        delay = next_tick - loop.time()
+        if delay < 0:
+            logger.warning(
+                f"Scheduler: Cycle overran the {CHECK_INTERVAL_SECONDS}s interval by {-delay:.1f}s; starting the next one now."
+            )
+            next_tick = loop.time()
+            delay = 0
+        logger.info(f"Scheduler: Cycle finished. Next check in {delay:.0f} seconds.")
+        await asyncio.sleep(delay)
@@ -1,8 +1,13 @@
+import asyncio
+import functools
 import uuid
 import time
-from datetime import timedelta
+import threading
 from shop_bot.utils import time_utils
 import logging
+import re
+import secrets
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
 from typing import List, Dict
 
@@ -11,8 +16,8 @@ from py3xui import Api, Client, Inbound
 from shop_bot.data_manager.database import (
     get_host,
     get_key_by_email,
-    get_keys_for_host,
-    update_key_by_email,
+    get_key_expiries_for_host,
+    update_keys_by_email,
     update_key_connection_string,
     purge_missing_key,
 )
@@ -38,6 +43,18 @@ _TRANSIENT_NETWORK_ERROR_MARKERS = (
     "timed out",
 )
 
+# Logged-in panel sessions, reused so repeat calls skip the login round trip.
+# Keyed by (host_url, username, password) so credential edits get a new session.
+_XUI_SESSION_TTL_SECONDS = 300
+_xui_sessions: dict[tuple[str, str, str], tuple[Api, float]] = {}
+_xui_sessions_lock = threading.Lock()
+
+# Client changes are read-modify-write of the whole inbound (get_by_id, edit,
+# inbound.update), so two concurrent writers on one host would drop each
+# other's edits. Writers on the same host take turns; different hosts don't block.
+_host_write_locks: dict[str, threading.RLock] = {}
+_host_write_locks_guard = threading.Lock()
+
 COUNTRY_FLAGS = {
     "🇱🇻": ["latvia", "latvija", "riga", "рига", "latvian"],
     "🇺🇸": ["usa", "united states", "america"],
@@ -81,30 +98,56 @@ COUNTRY_FLAGS = {
     "🇮🇱": ["israel", "израиль"],
 }
 
+# A flag emoji is a pair of regional indicator symbols
+_FLAG_EMOJI_RE = re.compile("[\U0001F1E6-\U0001F1FF]{2}")
+
+# All aliases in one alternation, longest first so "ukraine" wins over "uk"
+_ALIAS_TO_FLAG = {
+    alias: flag for flag, aliases in COUNTRY_FLAGS.items() for alias in aliases
+}
+_ALIAS_RE = re.compile(
+    "|".join(map(re.escape, sorted(_ALIAS_TO_FLAG, key=len, reverse=True)))
+)
+
 
+@functools.lru_cache(maxsize=256)
 def get_country_flag_by_host(host_name: str) -> str:
     """
     Determine country flag based on host name using a dictionary lookup.
     Checks if any alias in the dictionary is a substring of the host name.
+    Memoized: the same few host names are looked up on every key operation.
     """
     host_lower = host_name.lower()
-    logger.debug(f"Detecting flag for host: '{host_name}'")
+    logger.debug("Detecting flag for host: '%s'", host_name)
 
-    # Check for direct flag match in name first
-    for flag in COUNTRY_FLAGS.keys():
-        if flag in host_name:
-            return flag
+    # Check for a flag emoji in the name first (any country, not only known ones)
+    flag_match = _FLAG_EMOJI_RE.search(host_name)
+    if flag_match:
+        return flag_match.group()
 
-    # Check for aliases
-    for flag, aliases in COUNTRY_FLAGS.items():
-        for alias in aliases:
-            if alias in host_lower:
-                return flag
+    # Check for aliases (the first one found in the name wins)
+    alias_match = _ALIAS_RE.search(host_lower)
+    if alias_match:
+        return _ALIAS_TO_FLAG[alias_match.group()]
 
     logger.warning(f"No flag detected for host '{host_name}', defaulting to USA.")
     return "🇺🇸"  # Default to USA
 
 
+# ASCII-only class: spaces and non-ASCII characters are dropped along with the rest
+_NON_REMARK_CHARS_RE = re.compile(r"[^A-Za-z0-9_]+")
+
+
+@functools.lru_cache(maxsize=256)
+def build_server_remark(host_name: str) -> str:
+    """
+    Remark shown in client apps: country flag + host name reduced to ASCII
+    letters, digits and underscores (no leading underscores).
+    """
+    clean_server_name = _NON_REMARK_CHARS_RE.sub("", host_name).lstrip("_")
+    return f"{get_country_flag_by_host(host_name)}{clean_server_name}"
+
+
 def _log_host_error(host_url: str, error: Exception) -> None:
     """Log host connection errors with rate limiting to reduce log spam."""
     error_type = type(error).__name__
@@ -141,26 +184,81 @@ def _is_transient_network_error(error: Exception) -> bool:
     return any(marker in error_msg for marker in _TRANSIENT_NETWORK_ERROR_MARKERS)
 
 
+def _get_cached_session(session_key: tuple[str, str, str]) -> Api | None:
+    with _xui_sessions_lock:
+        cached = _xui_sessions.get(session_key)
+        if not cached:
+            return None
+        api, logged_in_at = cached
+        if time.monotonic() - logged_in_at >= _XUI_SESSION_TTL_SECONDS:
+            del _xui_sessions[session_key]
+            return None
+        return api
+
+
+def _store_session(session_key: tuple[str, str, str], api: Api) -> None:
+    now = time.monotonic()
+    with _xui_sessions_lock:
+        # Drop expired sessions (e.g. left behind by changed credentials)
+        for key, (_, logged_in_at) in list(_xui_sessions.items()):
+            if now - logged_in_at >= _XUI_SESSION_TTL_SECONDS:
+                del _xui_sessions[key]
+        _xui_sessions[session_key] = (api, now)
+
+
+def _drop_session(session_key: tuple[str, str, str]) -> None:
+    with _xui_sessions_lock:
+        _xui_sessions.pop(session_key, None)
+
+
+def _find_inbound(
+    api: Api, host_url: str, inbound_id: int
+) -> tuple[Api, Inbound | None]:
+    # Fetch just the configured inbound; listing every inbound (with all of
+    # their clients) is only the fallback when the by-id request fails.
+    try:
+        target_inbound = api.inbound.get_by_id(inbound_id)
+    except Exception as e:
+        logger.debug(
+            "get_by_id(%s) failed on '%s' (%s); falling back to the inbound list.",
+            inbound_id,
+            host_url,
+            e,
+        )
+        inbounds: List[Inbound] = api.inbound.get_list()
+        target_inbound = next(
+            (inbound for inbound in inbounds if inbound.id == inbound_id), None
+        )
+    if target_inbound is None:
+        logger.error(f"Inbound with ID '{inbound_id}' not found on host '{host_url}'")
+    return api, target_inbound
+
+
 def login_to_host(
     host_url: str, username: str, password: str, inbound_id: int
 ) -> tuple[Api | None, Inbound | None]:
     host_url = host_url.rstrip("/")
+    session_key = (host_url, username, password)
+
+    # The inbound is always fetched fresh; only the login is reused. A failure
+    # on a cached session (expired cookie, panel restart) falls back to a full login.
+    cached_api = _get_cached_session(session_key)
+    if cached_api is not None:
+        try:
+            return _find_inbound(cached_api, host_url, inbound_id)
+        except Exception as e:
+            logger.debug(
+                f"Cached XUI session for '{host_url}' failed ({e}); re-logging in."
+            )
+            _drop_session(session_key)
 
     for attempt in range(1, _XUI_LOGIN_ATTEMPTS + 1):
         try:
             api = Api(host=host_url, username=username, password=password)
             api.login()
-            inbounds: List[Inbound] = api.inbound.get_list()
-            target_inbound = next(
-                (inbound for inbound in inbounds if inbound.id == inbound_id), None
-            )
-
-            if target_inbound is None:
-                logger.error(
-                    f"Inbound with ID '{inbound_id}' not found on host '{host_url}'"
-                )
-                return api, None
-            return api, target_inbound
+            result = _find_inbound(api, host_url, inbound_id)
+            _store_session(session_key, api)
+            return result
         except ValueError as ve:
             logger.error(f"Configuration error for host '{host_url}': {ve}")
             return None, None
@@ -185,6 +283,28 @@ def login_to_host(
     return None, None
 
 
+def _host_write_lock(host_name: str) -> threading.RLock:
+    with _host_write_locks_guard:
+        lock = _host_write_locks.get(host_name)
+        if lock is None:
+            lock = _host_write_locks[host_name] = threading.RLock()
+        return lock
+
+
+def _serialized_per_host(host_name_of=lambda host_name: host_name):
+    """Run the decorated panel writer under its host's write lock."""
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(host, *args, **kwargs):
+            with _host_write_lock(host_name_of(host)):
+                return func(host, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 def _get_stream_network_security(inbound: Inbound) -> tuple[str, str]:
     network = "tcp"
     security = "none"
@@ -217,6 +337,25 @@ def _set_unlimited_traffic_fields(client: Client) -> bool:
     return changed
 
 
+def _new_client(
+    email: str, expiry_ms: int, enable: bool, flow: str, telegram_id: str | None
+) -> Client:
+    """Build a panel client with a fresh UUID and sub_id and unlimited traffic."""
+    client = Client(
+        id=str(uuid.uuid4()),
+        email=email,
+        enable=enable,
+        flow=flow,
+        expiry_time=expiry_ms,
+        sub_id=secrets.token_hex(8),
+        total_gb=0,
+        reset=0,
+        tg_id=telegram_id,
+    )
+    _set_unlimited_traffic_fields(client)
+    return client
+
+
 def _set_client_enabled_state(
     api: Api, inbound_id: int, email: str, enabled: bool
 ) -> bool:
@@ -292,6 +431,12 @@ def _normalize_client_traffic_state(api: Api, inbound_id: int, email: str) -> bo
         return False
 
 
+@functools.lru_cache(maxsize=64)
+def _hostname_of(host_url: str) -> str | None:
+    """Hostname part of a panel URL; there is one URL per configured host."""
+    return urlparse(host_url).hostname
+
+
 def get_connection_string(
     inbound: Inbound, user_uuid: str, host_url: str, remark: str
 ) -> str | None:
@@ -299,7 +444,7 @@ def get_connection_string(
         logger.error("Inbound is None")
         return None
 
-    parsed_url = urlparse(host_url)
+    hostname = _hostname_of(host_url)
     port = inbound.port
     protocol = getattr(inbound, "protocol", "unknown")
 
@@ -314,7 +459,12 @@ def get_connection_string(
     safe_remark = remark
 
     logger.debug(
-        f"Generating connection string - protocol: {protocol}, network: {network}, port: {port}, hostname: {parsed_url.hostname}, remark: {safe_remark}"
+        "Generating connection string - protocol: %s, network: %s, port: %s, hostname: %s, remark: %s",
+        protocol,
+        network,
+        port,
+        hostname,
+        safe_remark,
     )
 
     # Определяем тип протокола
@@ -322,21 +472,38 @@ def get_connection_string(
 
     if protocol_lower == "vless":
         return _get_vless_connection_string(
-            inbound, user_uuid, parsed_url.hostname, port, safe_remark, network
+            inbound, user_uuid, hostname, port, safe_remark, network
         )
     elif protocol_lower == "vmess":
         return _get_vmess_connection_string(
-            inbound, user_uuid, parsed_url.hostname, port, safe_remark
+            inbound, user_uuid, hostname, port, safe_remark
         )
     elif protocol_lower == "trojan":
         return _get_trojan_connection_string(
-            inbound, user_uuid, parsed_url.hostname, port, safe_remark
+            inbound, user_uuid, hostname, port, safe_remark
         )
     else:
         logger.error(f"Unsupported protocol: {protocol}")
         return None
 
 
+def _get_grpc_service_name(stream_settings) -> str:
+    """gRPC serviceName from stream settings given as a dict or an object."""
+    grpc_settings = getattr(stream_settings, "grpc_settings", None)
+    if isinstance(grpc_settings, dict):
+        return grpc_settings.get("serviceName", "")
+    return getattr(grpc_settings, "service_name", "")
+
+
+def _get_grpc_link_params(stream_settings) -> str:
+    """Query fragment for gRPC transport: serviceName (if set) and mode=gun."""
+    service_name = _get_grpc_service_name(stream_settings)
+    if service_name:
+        return f"&serviceName={service_name}&mode=gun"
+    # gRPC usually works with mode=gun or multi
+    return "&mode=gun"
+
+
 def _get_vless_connection_string(
     inbound: Inbound,
     user_uuid: str,
@@ -349,32 +516,39 @@ def _get_vless_connection_string(
 
     stream_settings = inbound.stream_settings
     logger.debug(
-        f"Generating VLESS connection string for inbound protocol: {getattr(inbound, 'protocol', 'unknown')}, network: {network}, port: {port}"
+        "Generating VLESS connection string for inbound protocol: %s, network: %s, port: %s",
+        getattr(inbound, "protocol", "unknown"),
+        network,
+        port,
     )
 
     # Common parameters
     base_link = f"vless://{user_uuid}@{hostname}:{port}?type={network}&encryption=none"
 
+    reality_settings = getattr(stream_settings, "reality_settings", None)
+    tls_settings = getattr(stream_settings, "tls_settings", None)
+
     # Проверяем Reality настройки (основной случай)
-    if (
-        hasattr(stream_settings, "reality_settings")
-        and stream_settings.reality_settings
-    ):
-        settings = stream_settings.reality_settings.get("settings")
+    if reality_settings:
+        settings = reality_settings.get("settings")
         if not settings:
             logger.warning("Reality settings not found in stream_settings")
             return None
 
         public_key = settings.get("publicKey")
         fp = settings.get("fingerprint")
-        server_names = stream_settings.reality_settings.get("serverNames")
-        short_ids = stream_settings.reality_settings.get("shortIds")
-
-        logger.debug(
-            f"Reality params - public_key: {bool(public_key)}, server_names: {bool(server_names)}, short_ids: {bool(short_ids)}"
-        )
+        server_names = reality_settings.get("serverNames")
+        short_ids = reality_settings.get("shortIds")
+
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(
+                "Reality params - public_key: %s, server_names: %s, short_ids: %s",
+                bool(public_key),
+                bool(server_names),
+                bool(short_ids),
+            )
 
-        if not all([public_key, server_names, short_ids]):
+        if not (public_key and server_names and short_ids):
             logger.warning("Missing required Reality parameters")
             return None
 
@@ -387,24 +561,12 @@ def _get_vless_connection_string(
         if network == "tcp":
             flow_param = "&flow=xtls-rprx-vision"
 
-        if network == "grpc":
-            # Extract grpc serviceName if available
-            service_name = ""
-            if hasattr(stream_settings, "grpc_settings"):
-                grpc_settings = stream_settings.grpc_settings
-                if isinstance(grpc_settings, dict):
-                    service_name = grpc_settings.get("serviceName", "")
-                elif hasattr(grpc_settings, "service_name"):  # Try object attribute
-                    service_name = grpc_settings.service_name
-
-            if service_name:
-                base_link += f"&serviceName={service_name}"
-
-            # gRPC usually works with mode=gun or multi
-            base_link += "&mode=gun"
+        grpc_params = (
+            _get_grpc_link_params(stream_settings) if network == "grpc" else ""
+        )
 
         connection_string = (
-            f"{base_link}"
+            f"{base_link}{grpc_params}"
             f"&security=reality&pbk={public_key}&fp={fp}&sni={server_name}"
             f"&sid={short_id}&spx=%2F{flow_param}#{remark}"
         )
@@ -414,27 +576,17 @@ def _get_vless_connection_string(
         return connection_string
 
     # Проверяем TLS настройки
-    elif hasattr(stream_settings, "tls_settings") and stream_settings.tls_settings:
-        tls_settings = stream_settings.tls_settings.get("settings", {})
-        server_name = tls_settings.get("serverName", hostname)
-        fp = tls_settings.get("fingerprint", "chrome")
-
-        if network == "grpc":
-            # Extract grpc serviceName
-            service_name = ""
-            if hasattr(stream_settings, "grpc_settings"):
-                grpc_settings = stream_settings.grpc_settings
-                if isinstance(grpc_settings, dict):
-                    service_name = grpc_settings.get("serviceName", "")
-                elif hasattr(grpc_settings, "service_name"):
-                    service_name = grpc_settings.service_name
-
-            if service_name:
-                base_link += f"&serviceName={service_name}"
-            base_link += "&mode=gun"
+    elif tls_settings:
+        tls_params = tls_settings.get("settings", {})
+        server_name = tls_params.get("serverName", hostname)
+        fp = tls_params.get("fingerprint", "chrome")
+
+        grpc_params = (
+            _get_grpc_link_params(stream_settings) if network == "grpc" else ""
+        )
 
         connection_string = (
-            f"{base_link}" f"&security=tls&sni={server_name}&fp={fp}#{remark}"
+            f"{base_link}{grpc_params}&security=tls&sni={server_name}&fp={fp}#{remark}"
         )
         logger.debug(
             "Generated TLS connection string for %s on %s", user_uuid, hostname
@@ -480,12 +632,15 @@ def update_or_create_client_on_panel(
     telegram_id: str = None,
     absolute_expiry_ms: int | None = None,
     preserve_longer_expiry: bool = True,
+    inbound: Inbound | None = None,
 ) -> tuple[str | None, int | None]:
     def _is_record_not_found_error(exc: Exception) -> bool:
         return "record not found" in str(exc).lower()
 
     try:
-        inbound_to_modify = api.inbound.get_by_id(inbound_id)
+        # Callers holding the host write lock may pass the inbound they just
+        # fetched in login_to_host; it is still current, so skip the re-fetch.
+        inbound_to_modify = inbound or api.inbound.get_by_id(inbound_id)
         if not inbound_to_modify:
             raise ValueError(f"Could not find inbound with ID {inbound_id}")
 
@@ -502,7 +657,9 @@ def update_or_create_client_on_panel(
             is_tcp_reality_vision = True
 
         logger.debug(
-            f"Determined target flow for client: '{target_flow}' (is_reality_vision={is_tcp_reality_vision})"
+            "Determined target flow for client: '%s' (is_reality_vision=%s)",
+            target_flow,
+            is_tcp_reality_vision,
         )
 
         client_index = -1
@@ -511,6 +668,8 @@ def update_or_create_client_on_panel(
                 client_index = i
                 break
 
+        now_ms = time_utils.get_timestamp_ms(time_utils.get_msk_now())
+
         if absolute_expiry_ms is not None:
             try:
                 target_expiry_ms = int(absolute_expiry_ms)
@@ -537,28 +696,20 @@ def update_or_create_client_on_panel(
                 new_expiry_ms = target_expiry_ms
         else:
             if seconds_to_add is not None:
-                delta = timedelta(seconds=int(seconds_to_add))
+                delta_ms = int(seconds_to_add) * 1000
             else:
-                delta = timedelta(days=int(days_to_add))
+                delta_ms = int(days_to_add) * 86_400_000
 
-            # Calculate expiry time for additive updates.
+            # Calculate expiry time for additive updates, in epoch milliseconds:
+            # extend a still-active client from its expiry, otherwise from now.
+            base_ms = now_ms
             if client_index != -1:
                 existing_client = inbound_to_modify.settings.clients[client_index]
-                if existing_client.expiry_time > time_utils.get_timestamp_ms(
-                    time_utils.get_msk_now()
-                ):
-                    current_expiry_dt = time_utils.from_timestamp_ms(
-                        existing_client.expiry_time
-                    )
-                    new_expiry_dt = current_expiry_dt + delta
-                else:
-                    new_expiry_dt = time_utils.get_msk_now() + delta
-            else:
-                new_expiry_dt = time_utils.get_msk_now() + delta
-
-            new_expiry_ms = time_utils.get_timestamp_ms(new_expiry_dt)
+                if existing_client.expiry_time > now_ms:
+                    base_ms = existing_client.expiry_time
+            new_expiry_ms = base_ms + delta_ms
 
-        current_ts_ms = time_utils.get_timestamp_ms(time_utils.get_msk_now())
+        current_ts_ms = now_ms
         should_enable_client = new_expiry_ms > current_ts_ms
 
         if client_index != -1:
@@ -575,16 +726,14 @@ def update_or_create_client_on_panel(
             client_to_update.flow = target_flow
 
             # Ensure all required parameters exist
-            if not hasattr(client_to_update, "sub_id") or not client_to_update.sub_id:
-                client_to_update.sub_id = uuid.uuid4().hex[:16]
+            if not getattr(client_to_update, "sub_id", None):
+                client_to_update.sub_id = secrets.token_hex(8)
 
             # Normalize to unlimited traffic for consistency across global hosts.
             # Otherwise legacy non-zero caps may cause "exhausted" on one host only.
             _set_unlimited_traffic_fields(client_to_update)
 
-            if telegram_id and (
-                not hasattr(client_to_update, "tg_id") or not client_to_update.tg_id
-            ):
+            if telegram_id and not getattr(client_to_update, "tg_id", None):
                 client_to_update.tg_id = telegram_id
 
             client_uuid = client_to_update.id
@@ -619,20 +768,14 @@ def update_or_create_client_on_panel(
                         f"Client '{email}' client.update fallback also failed with 'record not found' "
                         f"on inbound {inbound_id}. Trying recreate fallback."
                     )
-                    client_uuid = str(uuid.uuid4())
-                    subscription_id = uuid.uuid4().hex[:16]
-                    recreated_client = Client(
-                        id=client_uuid,
-                        email=email,
-                        enable=should_enable_client,
-                        flow=target_flow,
-                        expiry_time=new_expiry_ms,
-                        sub_id=subscription_id,
-                        total_gb=0,
-                        reset=0,
-                        tg_id=telegram_id,
+                    recreated_client = _new_client(
+                        email,
+                        new_expiry_ms,
+                        should_enable_client,
+                        target_flow,
+                        telegram_id,
                     )
-                    _set_unlimited_traffic_fields(recreated_client)
+                    client_uuid = recreated_client.id
                     api.client.add(inbound_id, [recreated_client])
                     logger.info(
                         f"Recreated client '{email}' (UUID: {client_uuid}) on inbound {inbound_id}"
@@ -648,22 +791,10 @@ def update_or_create_client_on_panel(
                 _refresh_reactivated_client_visual_state(api, inbound_id, email)
 
         else:
-            client_uuid = str(uuid.uuid4())
-            subscription_id = uuid.uuid4().hex[:16]
-
-            new_client = Client(
-                id=client_uuid,
-                email=email,
-                enable=should_enable_client,
-                flow=target_flow,
-                expiry_time=new_expiry_ms,
-                sub_id=subscription_id,
-                total_gb=0,
-                reset=0,
-                tg_id=telegram_id,
+            new_client = _new_client(
+                email, new_expiry_ms, should_enable_client, target_flow, telegram_id
             )
-            _set_unlimited_traffic_fields(new_client)
-
+            client_uuid = new_client.id
             api.client.add(inbound_id, [new_client])
             logger.info(f"Added new client '{email}' (UUID: {client_uuid})")
 
@@ -680,13 +811,43 @@ def update_or_create_client_on_panel(
         return None, None
 
 
-import asyncio
+# Panel calls are blocking HTTP. They run on their own pool so slow panels
+# can't exhaust the loop's default executor, and each host gets a small cap
+# on in-flight calls so bursts don't pile onto a single panel.
+_PANEL_CALLS_PER_HOST = 4
+_PANEL_EXECUTOR = ThreadPoolExecutor(max_workers=32, thread_name_prefix="xui")
+_host_semaphores: dict[str, asyncio.Semaphore] = {}
+
+
+async def _run_on_host(host_name: str | None, func, *args):
+    semaphore = _host_semaphores.get(host_name)
+    if semaphore is None:
+        semaphore = _host_semaphores[host_name] = asyncio.Semaphore(
+            _PANEL_CALLS_PER_HOST
+        )
+    async with semaphore:
+        return await asyncio.get_running_loop().run_in_executor(
+            _PANEL_EXECUTOR, functools.partial(func, *args)
+        )
+
+
+async def login_to_host_async(host: dict) -> tuple[Api | None, Inbound | None]:
+    """login_to_host for a host row, run on the panel pool under its host cap."""
+    return await _run_on_host(
+        host.get("host_name"),
+        login_to_host,
+        host["host_url"],
+        host["host_username"],
+        host["host_pass"],
+        host["host_inbound_id"],
+    )
 
 
 async def create_or_update_key_on_host(
     host_name: str, email: str, days_to_add: int, telegram_id: str = None
 ) -> Dict | None:
-    return await asyncio.to_thread(
+    return await _run_on_host(
+        host_name,
         _create_or_update_key_on_host_sync,
         host_name,
         email,
@@ -700,7 +861,8 @@ async def create_or_update_key_on_host(
 async def create_or_update_key_on_host_seconds(
     host_name: str, email: str, seconds_to_add: int, telegram_id: str = None
 ) -> Dict | None:
-    return await asyncio.to_thread(
+    return await _run_on_host(
+        host_name,
         _create_or_update_key_on_host_sync,
         host_name,
         email,
@@ -718,7 +880,8 @@ async def create_or_update_key_on_host_absolute_expiry(
     telegram_id: str = None,
     preserve_longer_expiry: bool = True,
 ) -> Dict | None:
-    return await asyncio.to_thread(
+    return await _run_on_host(
+        host_name,
         _create_or_update_key_on_host_sync,
         host_name,
         email,
@@ -730,6 +893,7 @@ async def create_or_update_key_on_host_absolute_expiry(
     )
 
 
+@_serialized_per_host()
 def _create_or_update_key_on_host_sync(
     host_name: str,
     email: str,
@@ -765,6 +929,7 @@ def _create_or_update_key_on_host_sync(
         telegram_id=telegram_id,
         absolute_expiry_ms=absolute_expiry_ms,
         preserve_longer_expiry=preserve_longer_expiry,
+        inbound=inbound,
     )
     if not client_uuid:
         logger.error(
@@ -772,22 +937,8 @@ def _create_or_update_key_on_host_sync(
         )
         return None
 
-    # Clean remark for URL safety
-    safe_remark = host_name.replace(" ", "_").encode("ascii", "ignore").decode("ascii")
-    # Determine country flag based on server name
-    country_flag = get_country_flag_by_host(host_name)
-    # Default is handled in the function (returns 🇺🇸)
-
     # Use server name (cleaned) with country flag for better UX
-    # Clean server name: remove non-ASCII, replace spaces, keep only alphanumeric and underscores
-    clean_server_name = (
-        host_name.replace(" ", "").encode("ascii", "ignore").decode("ascii")
-    )
-    # Remove any remaining special chars, keep only letters, numbers, underscores
-    clean_server_name = "".join(c for c in clean_server_name if c.isalnum() or c == "_")
-    # Remove leading underscores
-    clean_server_name = clean_server_name.lstrip("_")
-    server_remark = f"{country_flag}{clean_server_name}"
+    server_remark = build_server_remark(host_name)
     connection_string = get_connection_string(
         inbound, client_uuid, host_data["host_url"], remark=server_remark
     )
@@ -804,7 +955,9 @@ def _create_or_update_key_on_host_sync(
 
 
 async def get_key_details_from_host(key_data: dict) -> dict | None:
-    return await asyncio.to_thread(_get_key_details_from_host_sync, key_data)
+    return await _run_on_host(
+        key_data.get("host_name"), _get_key_details_from_host_sync, key_data
+    )
 
 
 def _get_key_details_from_host_sync(key_data: dict) -> dict | None:
@@ -831,20 +984,8 @@ def _get_key_details_from_host_sync(key_data: dict) -> dict | None:
     if not api or not inbound:
         return None
 
-    # Determine country flag based on server name
-    country_flag = get_country_flag_by_host(host_name)
-    # Default is handled in the function (returns 🇺🇸)
-
     # Use server name (cleaned) with country flag for better UX
-    # Clean server name: remove non-ASCII, replace spaces, keep only alphanumeric and underscores
-    clean_server_name = (
-        host_name.replace(" ", "").encode("ascii", "ignore").decode("ascii")
-    )
-    # Remove any remaining special chars, keep only letters, numbers, underscores
-    clean_server_name = "".join(c for c in clean_server_name if c.isalnum() or c == "_")
-    # Remove leading underscores
-    clean_server_name = clean_server_name.lstrip("_")
-    server_remark = f"{country_flag}{clean_server_name}"
+    server_remark = build_server_remark(host_name)
     connection_string = get_connection_string(
         inbound,
         key_data["xui_client_uuid"],
@@ -855,7 +996,9 @@ def _get_key_details_from_host_sync(key_data: dict) -> dict | None:
 
 
 async def get_client_traffic(key_data: dict) -> dict | None:
-    return await asyncio.to_thread(_get_client_traffic_sync, key_data)
+    return await _run_on_host(
+        key_data.get("host_name"), _get_client_traffic_sync, key_data
+    )
 
 
 def _get_client_traffic_sync(key_data: dict) -> dict | None:
@@ -889,7 +1032,9 @@ def _get_client_traffic_sync(key_data: dict) -> dict | None:
 
 
 async def get_connection_strings_for_host(host_name: str) -> dict[str, str]:
-    return await asyncio.to_thread(_get_connection_strings_for_host_sync, host_name)
+    return await _run_on_host(
+        host_name, _get_connection_strings_for_host_sync, host_name
+    )
 
 
 def _get_connection_strings_for_host_sync(host_name: str) -> dict[str, str]:
@@ -909,17 +1054,12 @@ def _get_connection_strings_for_host_sync(host_name: str) -> dict[str, str]:
     if not api or not inbound:
         return {}
 
-    inbound_fresh = api.inbound.get_by_id(inbound.id)
-    if not inbound_fresh or not inbound_fresh.settings.clients:
+    # login_to_host already returns the freshly fetched inbound
+    inbound_fresh = inbound
+    if not inbound_fresh.settings.clients:
         return {}
 
-    country_flag = get_country_flag_by_host(host_name)
-    clean_server_name = (
-        host_name.replace(" ", "").encode("ascii", "ignore").decode("ascii")
-    )
-    clean_server_name = "".join(c for c in clean_server_name if c.isalnum() or c == "_")
-    clean_server_name = clean_server_name.lstrip("_")
-    server_remark = f"{country_flag}{clean_server_name}"
+    server_remark = build_server_remark(host_name)
 
     result: dict[str, str] = {}
     for client in inbound_fresh.settings.clients:
@@ -938,11 +1078,12 @@ def _get_connection_strings_for_host_sync(host_name: str) -> dict[str, str]:
 
 async def fix_client_parameters_on_host(host_name: str, client_email: str) -> bool:
     """Fix flow and encryption parameters for existing client on host"""
-    return await asyncio.to_thread(
-        _fix_client_parameters_on_host_sync, host_name, client_email
+    return await _run_on_host(
+        host_name, _fix_client_parameters_on_host_sync, host_name, client_email
     )
 
 
+@_serialized_per_host()
 def _fix_client_parameters_on_host_sync(host_name: str, client_email: str) -> bool:
     """Sync version of fix_client_parameters_on_host"""
     host_data = get_host(host_name)
@@ -964,9 +1105,8 @@ def _fix_client_parameters_on_host_sync(host_name: str, client_email: str) -> bo
         return False
 
     try:
-        inbound_to_modify = api.inbound.get_by_id(inbound.id)
-        if not inbound_to_modify:
-            raise ValueError(f"Could not find inbound with ID {inbound.id}")
+        # login_to_host just fetched the inbound under this host's write lock
+        inbound_to_modify = inbound
 
         if inbound_to_modify.settings.clients is None:
             inbound_to_modify.settings.clients = []
@@ -1011,9 +1151,12 @@ def _fix_client_parameters_on_host_sync(host_name: str, client_email: str) -> bo
 
 
 async def fix_all_client_parameters_on_host(host_name: str) -> int:
-    return await asyncio.to_thread(_fix_all_client_parameters_on_host_sync, host_name)
+    return await _run_on_host(
+        host_name, _fix_all_client_parameters_on_host_sync, host_name
+    )
 
 
+@_serialized_per_host()
 def _fix_all_client_parameters_on_host_sync(host_name: str) -> int:
     host_data = get_host(host_name)
     if not host_data:
@@ -1034,13 +1177,11 @@ def _fix_all_client_parameters_on_host_sync(host_name: str) -> int:
         return 0
 
     try:
-        keys_in_db = get_keys_for_host(host_name)
+        keys_in_db = get_key_expiries_for_host(host_name)
         now = time_utils.get_msk_now()
 
-        # Fetch inbound once to detect missing clients
-        inbound_to_modify = api.inbound.get_by_id(inbound.id)
-        if not inbound_to_modify:
-            raise ValueError(f"Could not find inbound with ID {inbound.id}")
+        # login_to_host just fetched the inbound; use it to detect missing clients
+        inbound_to_modify = inbound
 
         if inbound_to_modify.settings.clients is None:
             inbound_to_modify.settings.clients = []
@@ -1051,7 +1192,18 @@ def _fix_all_client_parameters_on_host_sync(host_name: str) -> int:
             if getattr(c, "email", None)
         }
 
-        # Ensure all DB keys exist on panel (recreate if missing only)
+        network, security = _get_stream_network_security(inbound_to_modify)
+        target_flow = ""
+        if network == "tcp" and security == "reality":
+            target_flow = "xtls-rprx-vision"
+
+        server_remark = build_server_remark(host_name)
+
+        # Ensure all DB keys exist on panel (recreate if missing only):
+        # build every missing client first, then add them in one panel call
+        now_ms = time_utils.get_timestamp_ms(now)
+        pending_clients: list[Client] = []
+        pending_plan_ids: list[int] = []
         for key in keys_in_db:
             email = key.get("key_email")
             expiry_str = key.get("expiry_date")
@@ -1069,70 +1221,70 @@ def _fix_all_client_parameters_on_host_sync(host_name: str) -> int:
             if remaining_seconds <= 0:
                 continue
 
+            pending_clients.append(
+                _new_client(
+                    email, now_ms + remaining_seconds * 1000, True, target_flow, None
+                )
+            )
+            pending_plan_ids.append(key.get("plan_id"))
+
+        if pending_clients:
             try:
-                client_uuid, new_expiry_ms = update_or_create_client_on_panel(
-                    api,
-                    inbound.id,
-                    email,
-                    days_to_add=0,
-                    seconds_to_add=remaining_seconds,
-                    telegram_id=None,
+                api.client.add(inbound.id, pending_clients)
+                added = list(zip(pending_clients, pending_plan_ids))
+            except Exception as e:
+                # One rejected client fails the whole batch; retry one by one so
+                # only the bad ones are lost.
+                logger.warning(
+                    f"Batch add of {len(pending_clients)} missing clients failed on host '{host_name}' ({e}); adding one by one."
                 )
-                if client_uuid and new_expiry_ms:
-                    country_flag = get_country_flag_by_host(host_name)
-                    clean_server_name = (
-                        host_name.replace(" ", "")
-                        .encode("ascii", "ignore")
-                        .decode("ascii")
-                    )
-                    clean_server_name = "".join(
-                        c for c in clean_server_name if c.isalnum() or c == "_"
-                    ).lstrip("_")
-                    server_remark = f"{country_flag}{clean_server_name}"
-                    conn = get_connection_string(
-                        inbound,
-                        client_uuid,
-                        host_data["host_url"],
-                        remark=server_remark,
+                added = []
+                for client, plan_id in zip(pending_clients, pending_plan_ids):
+                    try:
+                        api.client.add(inbound.id, [client])
+                        added.append((client, plan_id))
+                    except Exception as client_error:
+                        logger.error(
+                            f"Failed to re-add client '{client.email}' on host '{host_name}': {client_error}"
+                        )
+
+            if added:
+                logger.info(
+                    f"Re-added {len(added)} missing clients on host '{host_name}'."
+                )
+                try:
+                    update_keys_by_email(
+                        [
+                            (
+                                client.email,
+                                host_name,
+                                client.id,
+                                client.expiry_time,
+                                get_connection_string(
+                                    inbound,
+                                    client.id,
+                                    host_data["host_url"],
+                                    remark=server_remark,
+                                ),
+                                plan_id,
+                            )
+                            for client, plan_id in added
+                        ]
                     )
-                    update_key_by_email(
-                        key_email=email,
-                        host_name=host_name,
-                        xui_client_uuid=client_uuid,
-                        expiry_timestamp_ms=new_expiry_ms,
-                        connection_string=conn,
-                        plan_id=key.get("plan_id"),
+                except Exception as e:
+                    logger.error(
+                        f"Failed to record {len(added)} re-added clients on host '{host_name}': {e}",
+                        exc_info=True,
                     )
-                    existing_emails.add(email)
-                time.sleep(0.2)
-            except Exception as e:
-                logger.error(
-                    f"Failed to ensure client '{email}' on host '{host_name}': {e}",
-                    exc_info=True,
-                )
 
-        # Refresh inbound after potential additions and fix parameters in bulk
-        inbound_to_modify = api.inbound.get_by_id(inbound.id)
-        if not inbound_to_modify:
-            raise ValueError(f"Could not find inbound with ID {inbound.id}")
+            # Refresh inbound so the bulk update below keeps the added clients
+            inbound_to_modify = api.inbound.get_by_id(inbound.id)
+            if not inbound_to_modify:
+                raise ValueError(f"Could not find inbound with ID {inbound.id}")
 
         if inbound_to_modify.settings.clients is None:
             inbound_to_modify.settings.clients = []
 
-        network, security = _get_stream_network_security(inbound_to_modify)
-        target_flow = ""
-        if network == "tcp" and security == "reality":
-            target_flow = "xtls-rprx-vision"
-
-        country_flag = get_country_flag_by_host(host_name)
-        clean_server_name = (
-            host_name.replace(" ", "").encode("ascii", "ignore").decode("ascii")
-        )
-        clean_server_name = "".join(
-            c for c in clean_server_name if c.isalnum() or c == "_"
-        ).lstrip("_")
-        server_remark = f"{country_flag}{clean_server_name}"
-
         updated = 0
         for client in inbound_to_modify.settings.clients:
             client.flow = target_flow
@@ -1176,11 +1328,12 @@ def _fix_all_client_parameters_on_host_sync(host_name: str) -> int:
 async def sync_clients_state_on_host(
     host_name: str, desired_by_email: dict[str, dict]
 ) -> dict:
-    return await asyncio.to_thread(
-        _sync_clients_state_on_host_sync, host_name, desired_by_email
+    return await _run_on_host(
+        host_name, _sync_clients_state_on_host_sync, host_name, desired_by_email
     )
 
 
+@_serialized_per_host()
 def _sync_clients_state_on_host_sync(
     host_name: str, desired_by_email: dict[str, dict]
 ) -> dict:
@@ -1223,9 +1376,8 @@ def _sync_clients_state_on_host_sync(
         return result
 
     try:
-        inbound_to_modify = api.inbound.get_by_id(inbound.id)
-        if not inbound_to_modify:
-            raise ValueError(f"Could not find inbound with ID {inbound.id}")
+        # login_to_host just fetched the inbound under this host's write lock
+        inbound_to_modify = inbound
 
         if inbound_to_modify.settings.clients is None:
             inbound_to_modify.settings.clients = []
@@ -1325,7 +1477,9 @@ def _sync_clients_state_on_host_sync(
 
 
 async def delete_client_on_host(host_name: str, client_email: str) -> bool:
-    return await asyncio.to_thread(_delete_client_on_host_sync, host_name, client_email)
+    return await _run_on_host(
+        host_name, _delete_client_on_host_sync, host_name, client_email
+    )
 
 
 def _delete_client_on_host_sync(host_name: str, client_email: str) -> bool:
@@ -1385,21 +1539,25 @@ async def sync_inbounds_xtls_from_all_hosts() -> dict[str, dict]:
     """
     from shop_bot.data_manager.database import get_all_hosts
 
-    all_hosts = get_all_hosts(only_enabled=True)
+    all_hosts = await asyncio.to_thread(get_all_hosts, only_enabled=True)
     if not all_hosts:
         logger.warning("No hosts configured in database. XTLS sync skipped.")
         return {"status": "no_hosts"}
 
     results = {}
 
+    # Panel login and inbound updates are blocking HTTP; keep them off the loop
     for host_info in all_hosts:
         host_name = host_info.get("host_name")
         logger.info(f"Starting XTLS sync for host: {host_name}")
-        results[host_name] = _sync_xtls_for_host(host_info)
+        results[host_name] = await _run_on_host(
+            host_name, _sync_xtls_for_host, host_info
+        )
 
     return results
 
 
+@_serialized_per_host(lambda host_info: host_info.get("host_name"))
 def _sync_xtls_for_host(host_info: dict) -> dict:
     """
     Synchronize XTLS settings for a single host.
@@ -1420,9 +1578,9 @@ def _sync_xtls_for_host(host_info: dict) -> dict:
             logger.error(f"Could not connect to host '{host_name}' for XTLS sync")
             return {"status": "connection_failed", "fixed": 0}
 
-        # Get fresh inbound data
-        inbound_fresh = api.inbound.get_by_id(inbound.id)
-        if not inbound_fresh or not inbound_fresh.settings.clients:
+        # login_to_host just fetched the inbound under this host's write lock
+        inbound_fresh = inbound
+        if not inbound_fresh.settings.clients:
             logger.warning(f"No clients found on host '{host_name}'")
             return {"status": "no_clients", "fixed": 0}
 
@@ -1,3 +1,4 @@
+import functools
 import pytz
 from datetime import datetime
 import logging
@@ -61,11 +62,14 @@ def from_timestamp_ms(ts_ms: int) -> datetime:
     return utc_dt.astimezone(MSK_TZ)
 
 
+@functools.lru_cache(maxsize=8192)
 def parse_iso_to_msk(date_str: str) -> datetime | None:
     """
     Parses an ISO date string (likely from DB).
     If naive, assumes UTC (to correct for DB storage issues).
     Returns MSK aware datetime.
+    Results are memoized: the same stored expiry strings are parsed every
+    scheduler cycle, and the pytz conversion dominates the cost.
     """
     if not date_str:
         return None
@@ -66,12 +66,17 @@ from shop_bot.data_manager.database import (
     get_recent_transactions,
     get_paginated_transactions,
     get_all_users,
+    iter_all_users,
     get_user_keys,
     ban_user,
     unban_user,
     delete_user_everywhere,
     get_setting,
     DB_FILE,
+    reset_connections,
+    ensure_processed_webhooks_table,
+    is_webhook_processed,
+    set_webhook_processed,
     register_user_if_not_exists,
     get_next_key_number,
     get_key_by_id,
@@ -252,9 +257,13 @@ def _restore_from_backup(zip_file, apply_env: bool = False) -> dict:
             )
             shutil.copyfile(DB_FILE, backup_path)
 
-        # Замена базы
+        # Замена базы: закрываем кэшированные соединения до и после подмены файла
+        reset_connections()
         shutil.copyfile(db_src, DB_FILE)
+        reset_connections()
         run_migration()
+        # The restored plans table may define different global plans
+        scheduler.invalidate_global_plan_ids_cache()
 
         if apply_env:
             env_src = extract_dir / ".env"
@@ -280,54 +289,6 @@ def _restore_from_backup(zip_file, apply_env: bool = False) -> dict:
         shutil.rmtree(temp_dir, ignore_errors=True)
 
 
-def _ensure_processed_webhooks_table():
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("""
-                CREATE TABLE IF NOT EXISTS processed_webhooks (
-                    provider TEXT NOT NULL,
-                    external_id TEXT NOT NULL,
-                    created_date TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
-                    PRIMARY KEY (provider, external_id)
-                )
-                """)
-            conn.commit()
-    except sqlite3.Error as e:
-        logger.error(f"Failed to ensure processed_webhooks table: {e}")
-
-
-def _is_webhook_processed(provider: str, external_id: str) -> bool:
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "SELECT 1 FROM processed_webhooks WHERE provider = ? AND external_id = ?",
-                (provider, external_id),
-            )
-            return cursor.fetchone() is not None
-    except sqlite3.Error as e:
-        logger.error(
-            f"Failed to check webhook processed for {provider}:{external_id}: {e}"
-        )
-        return False
-
-
-def _set_webhook_processed(provider: str, external_id: str) -> None:
-    try:
-        with sqlite3.connect(DB_FILE) as conn:
-            cursor = conn.cursor()
-            cursor.execute(
-                "INSERT OR IGNORE INTO processed_webhooks (provider, external_id) VALUES (?, ?)",
-                (provider, external_id),
-            )
-            conn.commit()
-    except sqlite3.Error as e:
-        logger.error(
-            f"Failed to set webhook processed for {provider}:{external_id}: {e}"
-        )
-
-
 def _sanitize_csv_cell(value) -> str:
     text = str(value or "")
     if text[:1] in {"=", "+", "-", "@"}:
@@ -427,7 +388,7 @@ def create_webhook_app(bot_controller_instance):
     global _bot_controller
     _bot_controller = bot_controller_instance
 
-    _ensure_processed_webhooks_table()
+    ensure_processed_webhooks_table()
 
     # Ensure template and static folder relative to this file's location
     base_dir = os.path.dirname(os.path.abspath(__file__))
@@ -975,7 +936,7 @@ def create_webhook_app(bot_controller_instance):
     def export_users_csv():
         rows = []
         now = time_utils.get_msk_now()
-        for user in get_all_users():
+        for user in iter_all_users():
             keys = get_user_keys(int(user["telegram_id"]))
             active_keys = 0
             for key in keys:
@@ -1123,12 +1084,8 @@ def create_webhook_app(bot_controller_instance):
                     if not api or not inbound:
                         issue_list.append("Не удалось подключиться к панели XUI")
                     else:
-                        inbound_fresh = api.inbound.get_by_id(inbound.id)
-                        clients = (
-                            (inbound_fresh.settings.clients or [])
-                            if inbound_fresh
-                            else []
-                        )
+                        # login_to_host already fetched this inbound by id
+                        clients = inbound.settings.clients or []
                         client = next(
                             (
                                 c
@@ -2305,6 +2262,7 @@ def create_webhook_app(bot_controller_instance):
             price=float(request.form["price"]),
             service_type=service_type,
         )
+        scheduler.invalidate_global_plan_ids_cache()
         flash(
             f"Новый тариф для хоста '{request.form['host_name']}' добавлен.", "success"
         )
@@ -2314,6 +2272,7 @@ def create_webhook_app(bot_controller_instance):
     @login_required
     def delete_plan_route(plan_id):
         delete_plan(plan_id)
+        scheduler.invalidate_global_plan_ids_cache()
         flash("Тариф успешно удален.", "success")
         return redirect(url_for("settings_page"))
 
@@ -2498,7 +2457,7 @@ def create_webhook_app(bot_controller_instance):
                     )
                     return "Bad Request", 400
 
-                if _is_webhook_processed("yookassa", payment_id):
+                if is_webhook_processed("yookassa", payment_id):
                     return "OK", 200
 
                 Configuration.account_id = shop_id
@@ -2593,7 +2552,7 @@ def create_webhook_app(bot_controller_instance):
                             )
                             return "Service Unavailable", 503
                         if processed_ok:
-                            _set_webhook_processed("yookassa", payment_id)
+                            set_webhook_processed("yookassa", payment_id)
                         else:
                             logger.warning(
                                 f"YooKassa webhook: Payment {payment_id} was not fulfilled successfully. "
@@ -2652,7 +2611,7 @@ def create_webhook_app(bot_controller_instance):
                     return "OK", 200
 
                 external_invoice_id = payload_data.get("invoice_id")
-                if external_invoice_id and _is_webhook_processed(
+                if external_invoice_id and is_webhook_processed(
                     "cryptobot", str(external_invoice_id)
                 ):
                     return "OK", 200
@@ -2678,7 +2637,7 @@ def create_webhook_app(bot_controller_instance):
                     external_id_fallback = hashlib.sha256(
                         payload_string.encode("utf-8")
                     ).hexdigest()
-                    if _is_webhook_processed("cryptobot", external_id_fallback):
+                    if is_webhook_processed("cryptobot", external_id_fallback):
                         return "OK", 200
 
                 metadata = None
@@ -2784,11 +2743,11 @@ def create_webhook_app(bot_controller_instance):
                             )
                     if processed_ok:
                         if external_invoice_id:
-                            _set_webhook_processed(
+                            set_webhook_processed(
                                 "cryptobot", str(external_invoice_id)
                             )
                         elif external_id_fallback:
-                            _set_webhook_processed("cryptobot", external_id_fallback)
+                            set_webhook_processed("cryptobot", external_id_fallback)
                     else:
                         logger.warning(
                             "CryptoBot webhook: payment was not fulfilled successfully. "